@@ -0,0 +1,62 @@
+import sys
+import time
+import tracemalloc
+
+from pyq.astmatch import ASTMatchEngine
+from sizzle.match import MatchEngine
+
+
+def previous_match(m, selector, data):
+    # the previous deduplication, a dict of the ids of all the nodes found
+    nodeids = {}
+    for selector in m.compile(selector):
+        for node in m.match_data(selector, data):
+            nodeid = id(node)
+            if nodeid not in nodeids:
+                nodeids[nodeid] = None
+                yield node
+
+
+def generated_module(functions, calls):
+    # a module as code generators write them, with many small functions
+    lines = []
+    for i in range(functions):
+        lines.append('def f{}(x):'.format(i))
+        for j in range(calls):
+            lines.append('    y{} = g{}(x)'.format(j, j))
+    return '\n'.join(lines) + '\n'
+
+
+def count(match, m, selector, data):
+    found = 0
+    for node in match(m, selector, data):
+        found += 1
+    return found
+
+
+def main(functions=20000, calls=10):
+    source = generated_module(int(functions), int(calls)).encode('utf-8')
+    m = ASTMatchEngine()
+    data = m.parse('generated.py', source).body
+
+    for name, match in (('previous', previous_match),
+                        ('current', MatchEngine.match)):
+        for selector in ('call', 'def call', 'def, call'):
+            m._tree = None
+            t = time.time()
+            found = count(match, m, selector, data)
+            t = time.time() - t
+
+            # peak memory of the search alone, the module is already parsed
+            m._tree = None
+            tracemalloc.start()
+            count(match, m, selector, data)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print('{:<9} {:<10} {:>7} matches  {:7.3f}s  {:7.1f} MB'.format(
+                name, selector, found, t, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,49 @@
+import glob
+import os
+import sys
+import time
+
+from pyq.astmatch import ASTMatchEngine
+
+
+SELECTORS = (
+    'class > def',
+    'class def',
+    'def call#eval',
+    'def attr#path',
+    'class def > call#len',
+    '> class > def',
+    'assign call',
+)
+
+
+def main(limit=200):
+    stdlib = os.path.dirname(os.__file__)
+    filenames = sorted(glob.glob(os.path.join(stdlib, '*.py')))[:int(limit)]
+
+    m = ASTMatchEngine()
+    modules = []
+    for fn in filenames:
+        with open(fn, 'rb') as fp:
+            modules.append(m.parse(fn, fp.read()))
+
+    print('{} files, parsed once'.format(len(modules)))
+    print('{:<24} {:>9} {:>9} {:>9}  auto picks'.format(
+        'selector', m.TOP_DOWN, m.BOTTOM_UP, m.AUTO))
+    for selector in SELECTORS:
+        times = []
+        for evaluation in (m.TOP_DOWN, m.BOTTOM_UP, m.AUTO):
+            m.evaluation = evaluation
+            t = time.time()
+            for module in modules:
+                list(m.match_module(selector, module))
+            times.append(time.time() - t)
+
+        m.evaluation = m.AUTO
+        print('{:<24} {:>8.3f}s {:>8.3f}s {:>8.3f}s  {}'.format(
+            selector, times[0], times[1], times[2],
+            m.strategy(m.compile(selector)[0])))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
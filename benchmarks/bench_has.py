@@ -0,0 +1,52 @@
+import sys
+import time
+
+from pyq.astmatch import ASTMatchEngine
+
+
+class PreviousEngine(ASTMatchEngine):
+    # the previous :has, walking the whole body of every candidate
+    @staticmethod
+    def pseudo_has(matcher, node, value):
+        for node, body in matcher.iter_data([node]):
+            if body:
+                return any(
+                    matcher.match_data(matcher.parse_selector(value)[0], body))
+
+    def __init__(self):
+        super(PreviousEngine, self).__init__()
+        self.register_pseudo('has', self.pseudo_has)
+
+
+def nested_module(depth, width):
+    # functions nested depth levels deep, each with width statements and
+    # the eval call only in the innermost one
+    lines = []
+    for level in range(depth):
+        indent = '    ' * level
+        lines.append('{}def f{}():'.format(indent, level))
+        for i in range(width):
+            lines.append('{}    x{} = len(y) + {}'.format(indent, i, i))
+    lines.append('{}eval(x)'.format('    ' * depth))
+    return '\n'.join(lines) + '\n'
+
+
+def main(depth=90, width=20):
+    source = nested_module(int(depth), int(width)).encode('utf-8')
+
+    # engines are created in turn, as pseudos are registered in a dict
+    # shared by all of them
+    for name, engine in (('previous', PreviousEngine),
+                         ('memoized', ASTMatchEngine)):
+        m = engine()
+        module = m.parse('nested.py', source)
+        for selector in ('def:has(call#eval)', 'def:not(:has(call#open))',
+                         'def:has(def call#eval)'):
+            t = time.time()
+            count = len(list(m.match_module(selector, module)))
+            print('{:<9} {:<26} {:>4} matches  {:8.3f}s'.format(
+                name, selector, count, time.time() - t))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import timeit
+
+from pyq.astmatch import ASTMatchEngine
+from pyq.pyq import matching_lines
+
+
+def reread_matching_lines(matches, filename):
+    # the previous implementation, reading the file from the top for every
+    # match
+    fp = None
+    for match, lineno in matches:
+        if fp is None:
+            fp = open(filename, 'rb')
+        else:
+            fp.seek(0)
+
+        i = 1
+        while True:
+            line = fp.readline()
+
+            if not line:
+                break
+
+            if i == lineno:
+                text = line.decode('utf-8')
+                yield text, lineno, match.col_offset
+                break
+
+            i += 1
+
+    if fp is not None:
+        fp.close()
+
+
+def main(calls=5000):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'calls.py')
+        with open(filename, 'w') as fp:
+            for i in range(calls):
+                fp.write('foo({})\n'.format(i))
+
+        matches = list(ASTMatchEngine().match('call', filename))
+
+        for name, fn in (('reread', reread_matching_lines),
+                         ('indexed', matching_lines)):
+            t = min(timeit.repeat(lambda: list(fn(matches, filename)),
+                                  number=1, repeat=3))
+            print('{:<8} {:>6} matches  {:8.3f}s  {:>10.0f} lines/s'.format(
+                name, len(matches), t, len(matches) / t))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import io
+import os
+import timeit
+
+import click
+from pygments import highlight
+from pygments.lexers.python import PythonLexer
+from pygments.formatters.terminal import TerminalFormatter
+
+from pyq.output import TextWriter
+
+
+def echo_matches(filename, matches, fp):
+    # the previous implementation, a new lexer and formatter for every line
+    # and one write (and flush) per line
+    for line, no, col in matches:
+        text = highlight(line.strip(), PythonLexer(), TerminalFormatter())
+        click.echo('{}:{}  {}'.format(filename, no, text), nl=False,
+                   file=fp, color=True)
+
+
+def write_matches(color):
+    def write(filename, matches, fp):
+        out = TextWriter(fp, color=color)
+        out.write(filename, matches)
+        out.close()
+    return write
+
+
+def main(lines=20000):
+    matches = [('    foo(bar, {}) + baz.bang\n'.format(i % 500), i + 1, 4)
+               for i in range(lines)]
+
+    with io.open(os.devnull, 'w') as fp:
+        for name, fn in (('echo', echo_matches),
+                         ('color', write_matches('always')),
+                         ('no-color', write_matches('never'))):
+            t = min(timeit.repeat(lambda: fn('foo.py', matches, fp),
+                                  number=1, repeat=3))
+            print('{:<9} {:>6} lines  {:8.3f}s  {:>10.0f} lines/s'.format(
+                name, lines, t, lines / t))
+
+
+if __name__ == '__main__':
+    main()
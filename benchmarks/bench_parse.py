@@ -0,0 +1,77 @@
+import ast
+import os
+import sys
+import time
+
+from pyq.astmatch import ASTParser
+from pyq.files import walk
+
+
+def astor_parse(sources):
+    # the previous parse of files matched without a source, opening them
+    # again through astor
+    import astor
+    for fn, source in sources:
+        astor.parsefile(fn)
+
+
+def parse(parser, sources):
+    for fn, source in sources:
+        parser.parse(source, fn)
+
+
+def parse_all(parser, sources):
+    # the modules kept alive, as the query server and benchmarks do, which
+    # every collection of the garbage collector has to go through
+    return [parser.parse(source, fn) for fn, source in sources]
+
+
+def main(limit=1000, repeat=3):
+    sources = []
+    for fn in walk(os.path.dirname(os.__file__)):
+        if 'test' in fn or 'site-packages' in fn:
+            continue
+        with open(fn, 'rb') as fp:
+            source = fp.read()
+        try:
+            ast.parse(source)
+        except (SyntaxError, ValueError):
+            continue
+        sources.append((fn, source))
+        if len(sources) == int(limit):
+            break
+    size = sum(len(source) for fn, source in sources)
+
+    print('{} files, {:.1f} MB'.format(len(sources), size / 1e6))
+
+    runs = []
+    try:
+        import astor  # noqa
+    except ImportError:
+        print('astor is not installed')
+    else:
+        runs.append(('astor.parsefile', lambda: astor_parse(sources)))
+
+    for pause_gc in (False, True):
+        parser = ASTParser(pause_gc=pause_gc)
+        runs.append(('ASTParser(pause_gc={})'.format(pause_gc),
+                     lambda parser=parser: parse(parser, sources)))
+    for pause_gc in (False, True):
+        parser = ASTParser(pause_gc=pause_gc)
+        runs.append(('ASTParser(pause_gc={}), kept'.format(pause_gc),
+                     lambda parser=parser: parse_all(parser, sources)))
+
+    # timeit would disable the garbage collector
+    for name, run in runs:
+        times = []
+        for i in range(int(repeat)):
+            t = time.time()
+            run()
+            times.append(time.time() - t)
+        t = min(times)
+        print('{:<32} {:>7.3f}s {:>8.0f} files/s {:>6.2f} MB/s'.format(
+            name, t, len(sources) / t, size / t / 1e6))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,55 @@
+import glob
+import os
+import sys
+import time
+
+from pyq import pyq
+from pyq.astmatch import ASTMatchEngine
+
+
+def slow_read(latency):
+    # reads a file after waiting as long as a slow disk or network
+    # filesystem would
+    read = pyq._read_file
+
+    def read_file(filename):
+        time.sleep(latency)
+        return read(filename)
+
+    return read_file
+
+
+def run(m, selector, filenames, depth):
+    count = 0
+    for fn, source in pyq.prefetch(filenames, depth):
+        if source is None:
+            source = pyq._read_file(fn)
+        count += len(list(m.match(selector, fn, source)))
+    return count
+
+
+def main(latency='0.005', limit='300'):
+    latency, limit = float(latency), int(limit)
+    stdlib = os.path.dirname(os.__file__)
+    filenames = sorted(glob.glob(os.path.join(stdlib, '*.py')))[:limit]
+
+    m = ASTMatchEngine()
+    selector = m.compile('def:has(call)')
+
+    # without prefetching, every file is read (and waited for) inline
+    pyq._read_file, read_file = slow_read(latency), pyq._read_file
+    try:
+        print('{} files, {:.1f}ms read latency'.format(
+            len(filenames), latency * 1000))
+        for depth in (0, 4, 16):
+            t = time.time()
+            count = run(m, selector, filenames, depth)
+            t = time.time() - t
+            print('depth {:<3} {:>6} matches  {:8.3f}s  {:>8.0f} files/s'
+                  .format(depth, count, t, len(filenames) / t))
+    finally:
+        pyq._read_file = read_file
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
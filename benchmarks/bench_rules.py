@@ -0,0 +1,63 @@
+import glob
+import os
+import sys
+import time
+
+from pyq.astmatch import ASTMatchEngine
+
+
+def make_rules(count):
+    # a policy of banned calls, deprecated imports and forbidden base
+    # classes, most of which never match
+    rules = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            selector = 'call#banned_{}'.format(i)
+        elif kind == 1:
+            selector = 'import[from=deprecated{}]'.format(i)
+        else:
+            selector = 'class:extends(#Forbidden{})'.format(i)
+        rules.append(('rule-{}'.format(i), selector))
+
+    # and a few that match everywhere
+    rules.extend([('eval', 'call#eval'), ('open', 'call#open'),
+                  ('methods', 'class > def'), ('os', 'import[from=os]')])
+    return rules
+
+
+def main(count=300, limit=100):
+    stdlib = os.path.dirname(os.__file__)
+    filenames = sorted(glob.glob(os.path.join(stdlib, '*.py')))[:int(limit)]
+
+    m = ASTMatchEngine()
+    rules = m.compile_rules(make_rules(int(count)))
+
+    # files are parsed once, only matching is timed
+    modules = []
+    for fn in filenames:
+        with open(fn, 'rb') as fp:
+            modules.append(m.parse(fn, fp.read()))
+
+    t = time.time()
+    separate = 0
+    for module in modules:
+        for rule_id, selector in rules:
+            separate += len(list(m.match_module(selector, module)))
+    separate_time = time.time() - t
+
+    t = time.time()
+    batch = 0
+    for module in modules:
+        batch += len(list(m.match_module_many(rules, module)))
+    batch_time = time.time() - t
+
+    print('{} rules, {} files'.format(len(rules), len(filenames)))
+    print('one pass per rule  {:>6} matches  {:8.3f}s'.format(
+        separate, separate_time))
+    print('single pass        {:>6} matches  {:8.3f}s'.format(
+        batch, batch_time))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,31 @@
+import sys
+import timeit
+
+from sizzle.selector import Selector
+
+
+def generate(count):
+    # distinct selectors as a generated rule set would have them, so
+    # memoization does not hide parsing
+    for i in range(count):
+        yield ('class#Model{0}:extends(Base) > def#get_{0}:has(call'
+               '[func=fetch{0}]), import[from=pkg{0}]'.format(i))
+
+
+def main(count=2000, runs=5):
+    selectors = list(generate(int(count)))
+    long_selector = ' '.join('def:has(call#f{})'.format(i)
+                             for i in range(int(count)))
+
+    for name, chars, fn in (
+            ('batch', sum(map(len, selectors)),
+             lambda: [Selector.parse(s) for s in selectors]),
+            ('long', len(long_selector),
+             lambda: Selector.parse(long_selector))):
+        t = min(timeit.repeat(fn, number=1, repeat=int(runs)))
+        print('{:<6} {:>8} chars  {:8.3f}s  {:>10.0f} chars/s'.format(
+            name, chars, t, chars / t))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+import timeit
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def python(*args):
+    proc = subprocess.Popen(
+        (sys.executable,) + args, cwd=os.path.join(ROOT, 'testfiles', 'cmd'),
+        env=dict(os.environ, PYTHONPATH=ROOT),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return err.decode('utf-8')
+
+
+def import_times(module):
+    # (cumulative seconds, module) of the slowest imports, from -X importtime
+    times = []
+    for line in python('-X', 'importtime', '-c',
+                       'import {}'.format(module)).splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            times.append((int(fields[1]) / 1e6, fields[2].rstrip()))
+    return sorted(times, reverse=True)
+
+
+def main(runs=10):
+    times = import_times('pyq.pyq')
+    print('import pyq.pyq: {:.3f}s'.format(times[0][0]))
+    for t, module in times[1:11]:
+        print('  {:.3f}s {}'.format(t, module))
+
+    for args in (('-c', 'pass'),
+                 ('-m', 'pyq.pyq', '-l', 'def', 'cmd.py'),
+                 ('-m', 'pyq.pyq', 'def', 'cmd.py')):
+        t = min(timeit.repeat(lambda: python(*args), number=1,
+                              repeat=int(runs)))
+        print('{:>8.3f}s  python {}'.format(t, ' '.join(args)))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,84 @@
+import ast
+import os
+import sys
+import timeit
+
+from pyq.astmatch import ASTMatchEngine
+
+
+def recursive_iter_node(node):
+    # the previous implementation of ASTMatchEngine.iter_node
+    silence = (ast.Expr,)
+
+    if not isinstance(node, silence):
+        try:
+            body = node.body
+
+            # check if is iterable
+            list(body)
+
+        except TypeError:
+            body = [node.body]
+
+        except AttributeError:
+            body = None
+
+        yield node, body
+
+    for attr in ('value', 'func', 'right', 'left'):
+        if hasattr(node, attr):
+            value = getattr(node, attr)
+            for n in reversed(list(recursive_iter_node(value))):
+                yield n
+
+
+def recursive_iter_data(data):
+    for node in data:
+        for n in recursive_iter_node(node):
+            yield n
+
+
+def walk(iter_data, data):
+    count = 0
+    for node, body in iter_data(data):
+        count += 1
+        if body:
+            count += walk(iter_data, body)
+    return count
+
+
+def main(filename=None):
+    if filename is None:
+        import _pydecimal
+        filename = _pydecimal.__file__
+
+    with open(filename, 'rb') as fp:
+        module = ast.parse(fp.read())
+
+    print('{} ({} bytes)'.format(filename, os.path.getsize(filename)))
+
+    m = ASTMatchEngine()
+    for name, iter_data in (('recursive', recursive_iter_data),
+                            ('iterative', m.iter_data)):
+        nodes = walk(iter_data, module.body)
+        t = min(timeit.repeat(lambda: walk(iter_data, module.body),
+                              number=5, repeat=3)) / 5
+        print('{:<10} {:>7} nodes  {:8.4f}s  {:>10.0f} nodes/s'.format(
+            name, nodes, t, nodes / t))
+
+    # long attribute chains used to hit the recursion limit
+    chain = ast.parse('x = a' + '.b' * 2000)
+    for name, iter_data in (('recursive', recursive_iter_data),
+                            ('iterative', m.iter_data)):
+        try:
+            nodes = walk(iter_data, chain.body)
+        except RuntimeError:
+            print('{:<10} 2000 attributes chain: recursion limit '
+                  'exceeded'.format(name))
+        else:
+            print('{:<10} 2000 attributes chain: {} nodes'.format(
+                name, nodes))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
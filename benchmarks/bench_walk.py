@@ -0,0 +1,61 @@
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from pyq.pyq import is_dir_ignored, walk_files
+
+
+def os_walk_files(paths, ignore_dir):
+    # the previous implementation, ignored directories were still walked
+    # and non-Python files filtered afterwards
+    for p in paths:
+        for root, dirs, files in os.walk(p):
+            dirs.sort()
+            if is_dir_ignored(root.lstrip('./'), *ignore_dir):
+                continue
+            for fn in sorted(files):
+                fn = os.path.join(root, fn)
+                if fn.endswith('.py'):
+                    yield fn
+
+
+def make_tree(root, packages, modules):
+    # a project next to a virtualenv with many more files than the project
+    for prefix, count in (('src', packages), ('venv/lib/site-packages',
+                                              packages * 10)):
+        for i in range(count):
+            path = os.path.join(root, prefix, 'pkg{}'.format(i))
+            os.makedirs(path)
+            for j in range(modules):
+                for ext in ('.py', '.pyc', '.txt'):
+                    open(os.path.join(path, 'mod{}{}'.format(j, ext)),
+                         'w').close()
+
+
+def main(packages=50, modules=10):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        make_tree(tmpdir, int(packages), int(modules))
+        with open(os.path.join(tmpdir, '.gitignore'), 'w') as fp:
+            fp.write('venv/\n')
+
+        cases = (
+            ('os.walk', lambda: list(os_walk_files([tmpdir],
+                                                   (('venv',), True)))),
+            ('ignore-dir', lambda: list(walk_files(
+                None, [tmpdir], (('venv',), True), ignore_files=False))),
+            ('gitignore', lambda: list(walk_files(
+                None, [tmpdir], ((), True)))),
+        )
+        for name, fn in cases:
+            count = len(fn())
+            t = min(timeit.repeat(fn, number=1, repeat=3))
+            print('{:<11} {:>6} files  {:8.3f}s'.format(name, count, t))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
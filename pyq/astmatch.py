@@ -1,22 +1,210 @@
-from sizzle.match import MatchEngine
+from sizzle.match import MatchEngine, RuleSet
+from sizzle.selector import Selector
 
 import ast
-import astor
+import gc
+import io
+import re
+import sys
+
+
+# keywords that must be present in the source of a file for a type to match
+TYPE_TOKENS = {
+    'class': b'class',
+    'def': b'def',
+    'import': b'import',
+}
+
+# attributes whose values are identifiers (or dotted names) taken literally
+# from the source, and the operators that require them to be present
+TOKEN_ATTRS = ('arg', 'from', 'full', 'kwarg', 'name')
+TOKEN_OPS = ('=', '^=', '*=', '$=')
+
+NON_ASCII = re.compile(b'[\x80-\xff]')
+
+# attributes holding the nodes found inside a node (other than its body)
+CHILD_ATTRS = ('value', 'func', 'right', 'left')
+
+
+class ASTSelector(Selector):
+    # :extends() takes the selector of a base class, or nothing for classes
+    # without bases
+    selector_pseudos = dict(Selector.selector_pseudos, extends=True)
 
 
 class ASTMatchEngine(MatchEngine):
-    def __init__(self):
+    selector_class = ASTSelector
+
+    # measured on the standard library, see TYPE_ESTIMATES
+    average_depth = 2.1
+    top_level = 0.08
+
+    def __init__(self, cache=None, parser=None, on_error=None):
+        # on_error(filename, error) is called for the files that cannot be
+        # parsed, which are then left out, instead of raising the error
         super(ASTMatchEngine, self).__init__()
         self.register_pseudo('extends', self.pseudo_extends)
-
-    def match(self, selector, filename):
-        module = astor.parsefile(filename)
+        self.attr_operators = frozenset(OPERATORS)
+        self.cache = cache
+        self.parser = parser or ASTParser()
+        self.on_error = on_error
+        self._required_tokens = {}
+        self._layouts = {}
+        self._attr_predicates = {}
+        self._attr_getters = dict(
+            (lft, dict(getters)) for lft, getters in ATTR_GETTERS.items())
+
+    def parse(self, filename, source=None):
+        if self.cache is not None:
+            module = self.cache.get(filename)
+            if module is not None:
+                return module
+
+        if source is None:
+            with open(filename, 'rb') as fp:
+                source = fp.read()
+        module = self.parser.parse(source, filename)
+
+        if self.cache is not None:
+            self.cache.set(filename, module)
+        return module
+
+    def parse_file(self, filename, source=None):
+        # the module of a file, None if it cannot be parsed and on_error is
+        # set
+        try:
+            return self.parse(filename, source)
+        except PARSE_ERRORS as e:
+            if self.on_error is None:
+                raise
+            self.on_error(filename, e)
+            return None
+
+    def match(self, selector, filename, source=None):
+        selector = self.compile(selector)
+
+        tokens = self.required_tokens(selector)
+        if tokens:
+            if source is None:
+                with open(filename, 'rb') as fp:
+                    source = fp.read()
+            if not self.has_tokens(source, tokens):
+                return
+
+        module = self.parse_file(filename, source)
+        if module is None:
+            return
+        for match in self.match_module(selector, module):
+            yield match
+
+    def match_module(self, selector, module):
         for match in super(ASTMatchEngine, self).match(selector, module.body):
-            lineno = match.lineno
-            if isinstance(match, (ast.ClassDef, ast.FunctionDef)):
-                for d in match.decorator_list:
-                    lineno += 1
-            yield match, lineno
+            yield match, self.node_lineno(match)
+
+    def match_many(self, rules, filename, source=None):
+        # (rule id, match, lineno) for all the rules, the ones that cannot
+        # match (see required_tokens) are left out and the file is not parsed
+        # if none can
+        rules = self.compile_rules(rules)
+
+        if source is None:
+            with open(filename, 'rb') as fp:
+                source = fp.read()
+
+        tokens = SourceTokens(source)
+        active = [(rule_id, group) for rule_id, group in rules
+                  if tokens.has(self.required_tokens(group))]
+        if not active:
+            return
+
+        if len(active) < len(rules):
+            rules = RuleSet(active)
+
+        module = self.parse_file(filename, source)
+        if module is None:
+            return
+        for match in self.match_module_many(rules, module):
+            yield match
+
+    def match_module_many(self, rules, module):
+        for rule_id, match in super(ASTMatchEngine, self).match_many(
+                rules, module.body):
+            yield rule_id, match, self.node_lineno(match)
+
+    def type_estimate(self, typ):
+        if typ:
+            return TYPE_ESTIMATES.get(typ, (0.0, 0.0, 0.0))
+        return 1.0, 1.0, self.average_depth
+
+    def selector_types(self, selector):
+        if selector.typ:
+            return TYPES.get(selector.typ, frozenset())
+        if selector.id_:
+            return frozenset(ID_GETTERS)
+        return None
+
+    def required_tokens(self, selectors):
+        # alternatives of tokens (one set per selector of the group), a file
+        # can only match if it contains all the tokens of one alternative
+        try:
+            return self._required_tokens[selectors]
+        except KeyError:
+            pass
+
+        alternatives = []
+        for selector in selectors:
+            tokens = self._selector_tokens(selector)
+            if not tokens:
+                alternatives = None
+                break
+            alternatives.append(frozenset(tokens))
+
+        self._required_tokens[selectors] = alternatives
+        return alternatives
+
+    def _selector_tokens(self, selector):
+        tokens = set()
+
+        while selector:
+            if selector.typ in TYPE_TOKENS:
+                tokens.add(TYPE_TOKENS[selector.typ])
+
+            if selector.id_:
+                tokens.update(self._literal_tokens(selector.id_))
+
+            for lft, op, rgt in selector.attrs:
+                if lft in TOKEN_ATTRS and op in TOKEN_OPS:
+                    tokens.update(self._literal_tokens(rgt))
+
+            for name, value in selector.pseudos:
+                if name not in ('has', 'extends'):
+                    continue
+                selectors = self.parse_selector(value)
+                # :extends() matches any of its selectors, so only a single
+                # one can contribute required tokens
+                if name == 'has' and selectors or \
+                        name == 'extends' and len(selectors) == 1:
+                    tokens.update(self._selector_tokens(selectors[0]))
+
+            selector = selector.next_selector
+
+        return tokens
+
+    @staticmethod
+    def _literal_tokens(value):
+        # dotted names may have whitespace around the dots in the source
+        tokens = []
+        for part in value.split('.'):
+            if part:
+                try:
+                    tokens.append(part.encode('ascii'))
+                except UnicodeError:
+                    pass
+        return tokens
+
+    @staticmethod
+    def has_tokens(source, alternatives):
+        return SourceTokens(source).has(alternatives)
 
     @staticmethod
     def pseudo_extends(matcher, node, value):
@@ -27,176 +215,453 @@ class ASTMatchEngine(MatchEngine):
             return node.bases == []
 
         bases = node.bases
-        selectors = value.split(',')
 
-        for selector in selectors:
-            matches = matcher.match_data(
-                matcher.parse_selector(selector)[0], bases)
+        for selector in matcher.parse_selector(value):
+            matches = matcher.match_data(selector, bases)
             if any(matches):
                 return True
 
     def match_type(self, typ, node):
-        if typ == 'class':
-            return isinstance(node, ast.ClassDef)
-
-        if typ == 'def':
-            return isinstance(node, ast.FunctionDef)
+        return type(node) in TYPES.get(typ, ())
 
-        if typ == 'import':
-            return isinstance(node, (ast.Import, ast.ImportFrom))
+    def compile_type(self, typ):
+        classes = TYPES.get(typ, frozenset())
+        return lambda node: type(node) in classes
 
-        if typ == 'assign':
-            return isinstance(node, ast.Assign)
+    def match_id(self, id_, node):
+        getter = ID_GETTERS.get(type(node))
+        return getter is not None and id_ in getter(node)
 
-        if typ == 'attr':
-            return isinstance(node, ast.Attribute)
+    def compile_id(self, id_):
+        getters = ID_GETTERS
 
-        if typ == 'call':
-            if isinstance(node, ast.Call):
-                return True
+        def predicate(node):
+            getter = getters.get(type(node))
+            return getter is not None and id_ in getter(node)
 
-            # Python 2.x compatibility
-            return hasattr(ast, 'Print') and isinstance(node, ast.Print)
+        return predicate
 
-    def match_id(self, id_, node):
-        if isinstance(node, (ast.ClassDef, ast.FunctionDef)):
-            return node.name == id_
-
-        if isinstance(node, ast.Name):
-            return node.id == id_
-
-        if isinstance(node, ast.Attribute):
-            return node.attr == id_
-
-        if isinstance(node, ast.Assign):
-            for target in node.targets:
-                if hasattr(target, 'id'):
-                    if target.id == id_:
-                        return True
-                if hasattr(target, 'elts'):
-                    if id_ in self._extract_names_from_tuple(target):
-                        return True
-                elif isinstance(target, ast.Subscript):
-                    if hasattr(target.value, 'id'):
-                        if target.value.id == id_:
-                            return True
-
-        if isinstance(node, ast.Call):
-            if isinstance(node.func, ast.Name) and node.func.id == id_:
-                return True
-
-        if id_ == 'print' \
-                and hasattr(ast, 'Print') and isinstance(node, ast.Print):
-            # Python 2.x compatibility
-            return True
+    def id_values(self, node):
+        getter = ID_GETTERS.get(type(node))
+        if getter is None:
+            return []
+        return getter(node)
 
     def match_attr(self, lft, op, rgt, node):
-        values = []
-
-        if lft == 'from':
-            if isinstance(node, ast.ImportFrom) and node.module:
-                values.append(node.module)
-
-        elif lft == 'full':
-            if isinstance(node, (ast.Import, ast.ImportFrom)):
-                module = ''
-                if isinstance(node, ast.ImportFrom):
-                    if node.module:
-                        module = node.module + '.'
-
-                for n in node.names:
-                    values.append(module + n.name)
-                    if n.asname:
-                        values.append(module + n.asname)
-
-        elif lft == 'name':
-            if isinstance(node, (ast.Import, ast.ImportFrom)):
-                for alias in node.names:
-                    if alias.asname:
-                        values.append(alias.asname)
-                    values.append(alias.name)
-
-            elif isinstance(node, ast.Call):
-                if hasattr(node.func, 'id'):
-                    values.append(node.func.id)
-
-            elif hasattr(ast, 'Print') and isinstance(node, ast.Print):
-                values.append('print')
-
-            elif isinstance(node, ast.Assign):
-                for target in node.targets:
-                    if hasattr(target, 'id'):
-                        values.append(target.id)
-                    elif hasattr(target, 'elts'):
-                        values.extend(self._extract_names_from_tuple(target))
-                    elif isinstance(target, ast.Subscript):
-                        if hasattr(target.value, 'id'):
-                            values.append(target.value.id)
-
-            elif hasattr(node, lft):
-                values.append(getattr(node, lft))
-
-        elif lft in ('kwarg', 'arg'):
-            if isinstance(node, ast.Call):
-                if lft == 'kwarg':
-                    values = [kw.arg for kw in node.keywords]
-                elif lft == 'arg':
-                    values = [arg.id for arg in node.args]
-
-        if op == '=':
-            return any(value == rgt for value in values)
-
-        if op == '!=':
-            return any(value != rgt for value in values)
-
-        if op == '*=':
-            return any(rgt in value for value in values)
-
-        if op == '^=':
-            return any(value.startswith(rgt) for value in values)
-
-        if op == '$=':
-            return any(value.endswith(rgt) for value in values)
-
-        raise Exception('Attribute operator {} not implemented'.format(op))
+        key = (lft, op, rgt)
+        try:
+            predicate = self._attr_predicates[key]
+        except KeyError:
+            predicate = self._attr_predicates[key] = \
+                self.compile_attr(lft, op, rgt)
+        return predicate(node)
+
+    def compile_attr(self, lft, op, rgt):
+        # a function telling whether a node matches [lft op rgt], with the
+        # value getters of lft and the operator looked up only once
+        try:
+            test = OPERATORS[op]
+        except KeyError:
+            raise Exception('Attribute operator {} not implemented'.format(op))
+
+        getters = self._attr_getters.get(lft)
+        if getters is None:
+            return lambda node: False
+
+        values = self._attr_getter(lft, getters)
+
+        def predicate(node):
+            return test(values(node), rgt)
+
+        return predicate
+
+    def attr_values(self, lft, node):
+        getters = self._attr_getters.get(lft)
+        if getters is None:
+            return []
+        return self._attr_getter(lft, getters)(node)
+
+    def _attr_getter(self, lft, getters):
+        # getters found by the fallback are remembered in getters
+        fallback = ATTR_FALLBACKS.get(lft)
+
+        def values(node):
+            cls = type(node)
+            try:
+                getter = getters[cls]
+            except KeyError:
+                getter = getters[cls] = fallback and fallback(node)
+            if getter is None:
+                return ()
+            return getter(node)
+
+        return values
+
+    def node_name(self, node):
+        # the name shown for a match, eg.: in --format=json records
+        names = self.id_values(node) or self.attr_values('name', node)
+        return names[0] if names else None
+
+    def node_lineno(self, node):
+        lineno = node.lineno
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef)):
+            for d in node.decorator_list:
+                lineno += 1
+        return lineno
 
     def iter_data(self, data):
+        # nodes are yielded followed by the nodes under their value, func,
+        # right and left attributes, each of those in reversed order so
+        # matches are returned in the sequence they are read, eg.: foo.bar.bang
+        #
+        # an explicit stack of (node, reverse) pairs is used instead of
+        # recursion, a reversed node is pushed before its children
+        layouts = self._layouts
+        stack = []
+        push = stack.append
+        pop = stack.pop
+
         for node in data:
-            for n in self.iter_node(node):
-                yield n
+            push(node)
+            push(False)
+
+            while stack:
+                reverse = pop()
+                node = pop()
+
+                try:
+                    silenced, has_body, children, rchildren = \
+                        layouts[type(node)]
+                except KeyError:
+                    silenced, has_body, children, rchildren = \
+                        self._layout(node)
+
+                if reverse:
+                    # yielded by the None pushed below, after its children
+                    push(node)
+                    push(None)
+                    for attr in children:
+                        push(getattr(node, attr))
+                        push(False)
+                    continue
+
+                if not silenced:
+                    if has_body:
+                        body = node.body
+                        if not isinstance(body, list):
+                            try:
+                                iter(body)
+                            except TypeError:
+                                body = [body]
+                    else:
+                        body = None
+
+                    yield node, body
+
+                if reverse is False:
+                    for attr in rchildren:
+                        push(getattr(node, attr))
+                        push(True)
+
+    def _layout(self, node):
+        # whether nodes of this type are silenced, have a body and which of
+        # the child attributes they have (in both orders)
+        children = tuple(attr for attr in CHILD_ATTRS if hasattr(node, attr))
+        layout = (
+            isinstance(node, ast.Expr),
+            hasattr(node, 'body'),
+            children,
+            tuple(reversed(children)),
+        )
+        self._layouts[type(node)] = layout
+        return layout
 
     def iter_node(self, node):
-        silence = (ast.Expr,)
+        return self.iter_data((node,))
 
-        if not isinstance(node, silence):
-            try:
-                body = node.body
 
-                # check if is iterable
-                list(body)
+class SourceTokens(object):
+    # tells whether a source contains the required tokens of selectors,
+    # looking for each token once however many selectors require it
+    def __init__(self, source):
+        self.source = source
+        self.found = {}
+        self.text = None
 
-            except TypeError:
-                body = [node.body]
+    def has(self, alternatives):
+        if not alternatives:
+            return True
+
+        found = self.found
+        source = self.source
+        for tokens in alternatives:
+            for token in tokens:
+                try:
+                    present = found[token]
+                except KeyError:
+                    present = found[token] = token in source
+                if not present:
+                    break
+            else:
+                return True
+
+        # non-ASCII identifiers are NFKC normalized by the parser, so they
+        # may match an ASCII token without containing it literally
+        text = self.normalized()
+        if text is None:
+            return False
+        if text is True:
+            return True
+
+        for tokens in alternatives:
+            if all(token in text for token in tokens):
+                return True
 
-            except AttributeError:
-                body = None
+        return False
+
+    def normalized(self):
+        # the normalized source, None if it is the same and True if it
+        # cannot be decoded
+        if self.text is None:
+            self.text = False
+            source = self.source
+            if sys.version_info[0] >= 3 and NON_ASCII.search(source):
+                import tokenize
+                import unicodedata
+                encoding, _ = tokenize.detect_encoding(
+                    io.BytesIO(source).readline)
+                try:
+                    text = source.decode(encoding)
+                except (UnicodeError, LookupError):
+                    self.text = True
+                else:
+                    self.text = unicodedata.normalize(
+                        'NFKC', text).encode('utf-8')
+        return self.text or None
+
+
+# errors of files that cannot be parsed: invalid syntax, undecodable source
+# or null bytes, depending on the Python version
+PARSE_ERRORS = (SyntaxError, ValueError)
+
+
+class ASTParser(object):
+    # parses the bytes of a file with the ast module, as Python would find
+    # its encoding from a BOM or a coding declaration
+    #
+    # the garbage collector is paused while parsing, as the many nodes
+    # created would trigger collections that find nothing to collect;
+    # type_comments and feature_version are passed to ast.parse (Python
+    # 3.8+), both are off by default
+    def __init__(self, type_comments=False, feature_version=None,
+                 pause_gc=True):
+        self.options = {}
+        if type_comments:
+            self.options['type_comments'] = True
+        if feature_version is not None:
+            self.options['feature_version'] = feature_version
+        self.pause_gc = pause_gc
+
+    def parse(self, source, filename='<unknown>'):
+        enabled = self.pause_gc and gc.isenabled()
+        if enabled:
+            gc.disable()
+        try:
+            try:
+                return ast.parse(source, filename, **self.options)
+            except SyntaxError:
+                text = decode_source(source)
+                if text is None:
+                    raise
+                return ast.parse(text, filename, **self.options)
+        finally:
+            if enabled:
+                gc.enable()
 
-            yield node, body
 
-        for attr in ('value', 'func', 'right', 'left'):
-            if hasattr(node, attr):
-                value = getattr(node, attr)
-                # reversed is used here so matches are returned in the
-                # sequence they are read, eg.: foo.bar.bang
-                for n in reversed(list(self.iter_node(value))):
-                    yield n
+def decode_source(source):
+    # the text of a source whose bytes do not match its declared encoding
+    # (or that declares an unknown one), with the characters that cannot be
+    # decoded replaced, None if it decodes fine; lines are still matched,
+    # only the undecodable strings differ
+    import tokenize
+    detect_encoding = getattr(tokenize, 'detect_encoding', None)
+    if detect_encoding is None or not isinstance(source, bytes):
+        return None
 
-    @classmethod
-    def _extract_names_from_tuple(cls, tupl):
-        r = []
-        for item in tupl.elts:
-            if hasattr(item, 'elts'):
-                r.extend(cls._extract_names_from_tuple(item))
-            else:
-                r.append(item.id)
-        return r
+    try:
+        encoding = detect_encoding(io.BytesIO(source).readline)[0]
+        source.decode(encoding)
+        return None
+    except SyntaxError:
+        encoding = 'utf-8'
+    except (LookupError, UnicodeDecodeError):
+        pass
+
+    try:
+        return source.decode(encoding, 'replace')
+    except LookupError:
+        return source.decode('utf-8', 'replace')
+
+
+def _name(node):
+    return [node.name]
+
+
+def _call_name(node):
+    if isinstance(node.func, ast.Name):
+        return [node.func.id]
+    return []
+
+
+def _print_name(node):
+    return ['print']
+
+
+def _target_names(node):
+    names = []
+    for target in node.targets:
+        if hasattr(target, 'id'):
+            names.append(target.id)
+        elif hasattr(target, 'elts'):
+            names.extend(_extract_names_from_tuple(target))
+        elif isinstance(target, ast.Subscript):
+            if hasattr(target.value, 'id'):
+                names.append(target.value.id)
+    return names
+
+
+def _extract_names_from_tuple(tupl):
+    r = []
+    for item in tupl.elts:
+        if hasattr(item, 'elts'):
+            r.extend(_extract_names_from_tuple(item))
+        elif hasattr(item, 'id'):
+            r.append(item.id)
+    return r
+
+
+def _import_from(node):
+    if node.module:
+        return [node.module]
+    return []
+
+
+def _import_full(node):
+    values = []
+    module = ''
+    if isinstance(node, ast.ImportFrom):
+        if node.module:
+            module = node.module + '.'
+
+    for n in node.names:
+        values.append(module + n.name)
+        if n.asname:
+            values.append(module + n.asname)
+    return values
+
+
+def _import_names(node):
+    values = []
+    for alias in node.names:
+        if alias.asname:
+            values.append(alias.asname)
+        values.append(alias.name)
+    return values
+
+
+def _call_kwargs(node):
+    return [kw.arg for kw in node.keywords]
+
+
+def _call_args(node):
+    return [arg.id for arg in node.args if isinstance(arg, ast.Name)]
+
+
+def _name_fallback(node):
+    # any other node with a name, eg.: [name=foo] matching def foo()
+    if hasattr(node, 'name'):
+        return _name
+    return None
+
+
+# Python 2.x compatibility
+PRINT = (ast.Print,) if hasattr(ast, 'Print') else ()
+
+# node classes of each type
+TYPES = {
+    'class': frozenset((ast.ClassDef,)),
+    'def': frozenset((ast.FunctionDef,)),
+    'import': frozenset((ast.Import, ast.ImportFrom)),
+    'assign': frozenset((ast.Assign,)),
+    'attr': frozenset((ast.Attribute,)),
+    'call': frozenset((ast.Call,) + PRINT),
+}
+
+# the fraction of the nodes matched by each type, and the average number of
+# nodes in their body (directly and in all), measured on the standard library
+TYPE_ESTIMATES = {
+    'class': (0.006, 11.0, 100.0),
+    'def': (0.055, 8.5, 15.5),
+    'import': (0.01, 0.0, 0.0),
+    'assign': (0.13, 0.0, 0.0),
+    'attr': (0.11, 0.0, 0.0),
+    'call': (0.12, 0.0, 0.0),
+}
+
+# functions returning the names matched by #name, per node class
+ID_GETTERS = {
+    ast.ClassDef: _name,
+    ast.FunctionDef: _name,
+    ast.Name: lambda node: [node.id],
+    ast.Attribute: lambda node: [node.attr],
+    ast.Assign: _target_names,
+    ast.Call: _call_name,
+}
+ID_GETTERS.update((cls, _print_name) for cls in PRINT)
+
+# functions returning the values of each attribute, per node class
+ATTR_GETTERS = {
+    'from': {
+        ast.ImportFrom: _import_from,
+    },
+    'full': {
+        ast.Import: _import_full,
+        ast.ImportFrom: _import_full,
+    },
+    'name': {
+        ast.Import: _import_names,
+        ast.ImportFrom: _import_names,
+        ast.Call: lambda node: [node.func.id] if hasattr(node.func, 'id')
+        else [],
+        ast.Assign: _target_names,
+    },
+    'kwarg': {
+        ast.Call: _call_kwargs,
+    },
+    'arg': {
+        ast.Call: _call_args,
+    },
+}
+ATTR_GETTERS['name'].update((cls, _print_name) for cls in PRINT)
+
+# called with nodes of classes missing from ATTR_GETTERS to find a getter
+ATTR_FALLBACKS = {
+    'name': _name_fallback,
+}
+
+OPERATORS = {
+    '=': lambda values, rgt: rgt in values,
+    '!=': lambda values, rgt: any(value != rgt for value in values),
+    '*=': lambda values, rgt: any(rgt in value for value in values),
+    '^=': lambda values, rgt: any(value.startswith(rgt) for value in values),
+    '$=': lambda values, rgt: any(value.endswith(rgt) for value in values),
+}
+
+
+def compare(op, values, rgt):
+    try:
+        test = OPERATORS[op]
+    except KeyError:
+        raise Exception('Attribute operator {} not implemented'.format(op))
+    return test(values, rgt)
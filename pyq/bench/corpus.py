@@ -0,0 +1,81 @@
+import os
+import random
+
+
+def generate(directory, files=100, depth=3, classes=2, defs=4, calls=6,
+             seed=0):
+    # writes files modules under directory and returns their filenames;
+    # each module has classes nested depth levels deep (classes per level),
+    # defs methods per class and module-level functions, and calls
+    # statements per function; the same seed gives the same files
+    rng = random.Random(seed)
+    filenames = []
+    for i in range(files):
+        package = os.path.join(directory, 'pkg{}'.format(i // 50))
+        if not os.path.isdir(package):
+            os.makedirs(package)
+        filename = os.path.join(package, 'mod{}.py'.format(i))
+        with open(filename, 'w') as fp:
+            fp.write(module_source(rng, depth, classes, defs, calls))
+        filenames.append(filename)
+    return filenames
+
+
+def module_source(rng, depth=3, classes=2, defs=4, calls=6):
+    lines = [
+        'import os',
+        'import sys',
+        'from collections import namedtuple, OrderedDict',
+        '',
+        'CONSTANT = {}'.format(rng.randint(0, 1000)),
+        '',
+    ]
+
+    def function(indent, name, method):
+        pad = '    ' * indent
+        args = 'self, x, y=None' if method else 'x, y=None'
+        lines.append('{}def {}({}):'.format(pad, name, args))
+        pad += '    '
+        for k in range(calls):
+            n = rng.randint(0, 20)
+            kind = rng.randint(0, 5)
+            if kind == 0:
+                lines.append('{}v{} = self.helper{}(x.attr{}, y)'.format(
+                    pad, k, n, n) if method else
+                    '{}v{} = helper{}(x.attr{}, y)'.format(pad, k, n, n))
+            elif kind == 1:
+                lines.append('{}path = os.path.join(x, "part{}")'.format(
+                    pad, n))
+            elif kind == 2:
+                lines.append('{}if x.flag{}:'.format(pad, n))
+                lines.append('{}    y = compute{}(x) + len(y or ())'.format(
+                    pad, n))
+            elif kind == 3:
+                lines.append('{}for item in sorted(x.items{}):'.format(
+                    pad, n))
+                lines.append('{}    sys.stdout.write(str(item))'.format(pad))
+            elif kind == 4:
+                lines.append('{}result = eval(x.expr{})'.format(pad, n))
+            else:
+                lines.append('{}x.value{} = y.a.b.c{}()'.format(pad, n, n))
+        lines.append('{}return x'.format(pad))
+        lines.append('')
+
+    def cls(indent, level, name):
+        pad = '    ' * indent
+        lines.append('{}class {}(Base{}):'.format(pad, name,
+                                                  rng.randint(0, 9)))
+        lines.append('{}    attr = {}'.format(pad, rng.randint(0, 100)))
+        lines.append('')
+        for i in range(defs):
+            function(indent + 1, 'method{}'.format(i), True)
+        if level < depth:
+            for j in range(classes):
+                cls(indent + 1, level + 1, '{}Inner{}'.format(name, j))
+
+    for i in range(classes):
+        cls(0, 1, 'Class{}'.format(i))
+    for i in range(defs):
+        function(0, 'function{}'.format(i), False)
+
+    return '\n'.join(lines) + '\n'
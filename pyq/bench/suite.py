@@ -0,0 +1,210 @@
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+import click
+
+from ..astmatch import ASTMatchEngine
+from ..files import walk
+from .corpus import generate
+from sizzle.selector import Selector
+
+
+# the selectors matched against the corpus, from plain types to nested
+# combinators and pseudos
+SELECTORS = (
+    'class',
+    'def',
+    'call',
+    'class > def',
+    'class def',
+    'def call#eval',
+    'def attr#path',
+    'class:has(call#eval)',
+    '[from=collections]',
+    'class > def, call#len',
+)
+
+# parsed without the compiled selectors cache, each of them a number of
+# times
+PARSE_SELECTORS = SELECTORS + (
+    'class#Foo > def#bar:has(call#baz) call[id=x]',
+    ':not(class) > def:has(call:has(attr#path))',
+)
+
+
+@click.command()
+@click.option('--files', type=int, default=100, show_default=True,
+              help='Number of generated files.')
+@click.option('--depth', type=int, default=3, show_default=True,
+              help='Nesting depth of the generated classes.')
+@click.option('--classes', type=int, default=2, show_default=True,
+              help='Classes per module and per enclosing class.')
+@click.option('--defs', type=int, default=4, show_default=True,
+              help='Functions per module and methods per class.')
+@click.option('--calls', type=int, default=6, show_default=True,
+              help='Statements per function.')
+@click.option('--seed', type=int, default=0, show_default=True,
+              help='Seed of the generated files.')
+@click.option('--corpus', type=click.Path(exists=True, file_okay=False),
+              help='Search the Python files of a directory instead of '
+                   'generated ones.')
+@click.option('--repeat', type=int, default=3, show_default=True,
+              help='Runs of each benchmark, the fastest one is reported.')
+@click.option('--json', 'as_json', is_flag=True, default=False,
+              help='Print results as JSON.')
+@click.option('--compare', type=click.File(), metavar='FILE',
+              help='JSON results of a previous run to compare with.')
+def main(files, depth, classes, defs, calls, seed, corpus, repeat, as_json,
+         compare):
+    """Measure the speed of pyq's parsing, traversal and matching."""
+    tmpdir = None
+    if corpus is None:
+        tmpdir = tempfile.mkdtemp(prefix='pyq-bench-')
+        filenames = generate(tmpdir, files, depth, classes, defs, calls,
+                             seed)
+        params = {'files': files, 'depth': depth, 'classes': classes,
+                  'defs': defs, 'calls': calls, 'seed': seed}
+    else:
+        filenames = list(walk(corpus))
+        params = {'directory': corpus}
+
+    try:
+        results = run(filenames, repeat)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    results['corpus'].update(params)
+
+    if as_json:
+        click.echo(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        report(results, json.load(compare) if compare else None)
+
+
+def run(filenames, repeat=3):
+    m = ASTMatchEngine()
+
+    sources = []
+    for fn in filenames:
+        with open(fn, 'rb') as fp:
+            sources.append((fn, fp.read()))
+
+    modules = [m.parse(fn, source) for fn, source in sources]
+    nodes = sum(count_nodes(m, module.body) for module in modules)
+
+    benchmarks = []
+
+    def bench(name, fn, per_file=True, per_node=True):
+        seconds = best(fn, repeat)
+        result = {'name': name, 'seconds': seconds}
+        if per_file:
+            result['files_per_second'] = len(filenames) / seconds
+        if per_node:
+            result['nodes_per_second'] = nodes / seconds
+        benchmarks.append(result)
+
+    def parse_selectors():
+        for selector in PARSE_SELECTORS:
+            for i in range(100):
+                Selector.parse(selector)
+
+    bench('parse selectors', parse_selectors, per_file=False, per_node=False)
+    benchmarks[-1]['selectors_per_second'] = \
+        len(PARSE_SELECTORS) * 100 / benchmarks[-1]['seconds']
+
+    bench('parse files', lambda: [m.parse(fn, source)
+                                  for fn, source in sources])
+    bench('traverse', lambda: [count_nodes(m, module.body)
+                               for module in modules])
+
+    for selector in SELECTORS:
+        # parsed once, matched over the parsed modules
+        bench('match {}'.format(selector),
+              lambda: [list(m.match_module(selector, module))
+                       for module in modules])
+
+    # what a search does for each file: look for the selector tokens,
+    # parse and match
+    bench('search def call#eval',
+          lambda: [list(m.match('def call#eval', fn, source))
+                   for fn, source in sources])
+    rules = m.compile_rules([(selector, selector) for selector in SELECTORS])
+    bench('rules', lambda: [list(m.match_many(rules, fn, source))
+                            for fn, source in sources])
+
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'corpus': {'files': len(filenames),
+                   'bytes': sum(len(source) for fn, source in sources),
+                   'nodes': nodes},
+        'benchmarks': benchmarks,
+        'peak_rss': peak_rss(),
+    }
+
+
+def best(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=max(1, repeat)))
+
+
+def count_nodes(m, data):
+    count = 0
+    stack = [data]
+    while stack:
+        for node, body in m.iter_data(stack.pop()):
+            count += 1
+            if body:
+                stack.append(body)
+    return count
+
+
+def peak_rss():
+    # bytes, None where the resource module is not available
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss
+
+
+def report(results, previous=None):
+    corpus = results['corpus']
+    click.echo('{} files, {:.1f} MB, {} nodes, Python {}'.format(
+        corpus['files'], corpus['bytes'] / 1e6, corpus['nodes'],
+        results['python']))
+
+    before = {}
+    if previous is not None:
+        before = dict((b['name'], b['seconds'])
+                      for b in previous['benchmarks'])
+
+    click.echo('{:<28} {:>9} {:>10} {:>12}{}'.format(
+        'benchmark', 'seconds', 'files/s', 'nodes/s',
+        '  speedup' if previous is not None else ''))
+    for b in results['benchmarks']:
+        line = '{:<28} {:>9.4f} {:>10} {:>12}'.format(
+            b['name'], b['seconds'], _rate(b.get('files_per_second')),
+            _rate(b.get('nodes_per_second')))
+        if b['name'] in before:
+            line += '  {:>6.2f}x'.format(before[b['name']] / b['seconds'])
+        click.echo(line)
+
+    if results['peak_rss'] is not None:
+        click.echo('peak RSS: {:.1f} MB'.format(results['peak_rss'] / 1e6))
+
+
+def _rate(value):
+    return '' if value is None else '{:.0f}'.format(value)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import ast
+import gc
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+
+FORMAT_VERSION = 1
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# the only node fields the match engine reads, everything else is dropped
+# before storing a module
+FIELDS = frozenset((
+    'args', 'arg', 'asname', 'attr', 'bases', 'body', 'decorator_list',
+    'elts', 'func', 'id', 'keywords', 'left', 'level', 'module', 'name',
+    'names', 'right', 'targets', 'value',
+))
+
+ATTRIBUTES = ('lineno', 'col_offset', 'end_lineno', 'end_col_offset')
+
+_replace = getattr(os, 'replace', os.rename)
+
+NODE_CLASSES = dict(
+    (name, cls) for name, cls in vars(ast).items()
+    if isinstance(cls, type) and issubclass(cls, ast.AST)
+)
+
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'pyq')
+
+
+class ParseCache(object):
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory or default_cache_dir()
+        self.max_size = max_size
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def get(self, filename):
+        path, key = self._entry(filename)
+
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+        except (IOError, OSError):
+            return None
+
+        try:
+            version, entry_key, tree = marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            return None
+
+        if version != FORMAT_VERSION or entry_key != key:
+            return None
+
+        # entries are evicted by modification time, touching them on every
+        # hit makes the eviction least recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return _without_gc(decode, tree)
+
+    def set(self, filename, module):
+        path, key = self._entry(filename)
+
+        try:
+            data = marshal.dumps((FORMAT_VERSION, key, encode(module)))
+        except (RuntimeError, ValueError):
+            # too deeply nested to be stored, it will be parsed every time
+            return
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            _replace(tmp, path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def prune(self):
+        entries = []
+        total = 0
+
+        for fn in os.listdir(self.directory):
+            path = os.path.join(self.directory, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        if total <= self.max_size:
+            return
+
+        # drop the least recently used entries until 90% of the limit
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def _entry(self, filename):
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+        key = (filename, mtime, st.st_size, sys.version)
+        name = hashlib.sha1(filename.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.pyqc'), key
+
+
+def encode(node):
+    # nodes are stored as lists: [class name, lineno, col_offset,
+    # end_lineno, end_col_offset, field, value, field, value, ...], lists of
+    # nodes as tuples and everything else as is
+    if isinstance(node, ast.AST):
+        data = [type(node).__name__]
+        for attr in ATTRIBUTES:
+            data.append(getattr(node, attr, None))
+        for field in node._fields:
+            if field in FIELDS:
+                data.append(field)
+                data.append(encode(getattr(node, field, None)))
+        return data
+
+    if isinstance(node, list):
+        return tuple(encode(n) for n in node)
+
+    return node
+
+
+def decode(data):
+    typ = type(data)
+
+    if typ is list:
+        cls = NODE_CLASSES[data[0]]
+        node = cls.__new__(cls)
+        attrs = node.__dict__
+        if data[1] is not None:
+            attrs['lineno'] = data[1]
+            attrs['col_offset'] = data[2]
+            if data[3] is not None:
+                attrs['end_lineno'] = data[3]
+                attrs['end_col_offset'] = data[4]
+        for i in range(5, len(data), 2):
+            attrs[data[i]] = decode(data[i + 1])
+        return node
+
+    if typ is tuple:
+        return [decode(n) for n in data]
+
+    return data
+
+
+def _without_gc(fn, *args):
+    # building lots of small objects triggers the cyclic garbage collector
+    # over and over, while none of them can be garbage yet
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return fn(*args)
+    finally:
+        if enabled:
+            gc.enable()
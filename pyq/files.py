@@ -0,0 +1,408 @@
+import os
+import re
+import struct
+import sys
+
+
+IGNORE_FILES = ('.gitignore', '.pyqignore')
+
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    scandir = None
+
+
+def walk(top, extensions=('.py',), ignore_dir=None, hidden=False,
+         ignore_files=IGNORE_FILES):
+    # files under top with one of the given extensions, files of a directory
+    # come before its subdirectories and both are sorted by name
+    #
+    # directories are pruned before being read: hidden ones (unless hidden is
+    # set), those for which ignore_dir(path) is true and those excluded by the
+    # ignore files found along the way
+    stack = [(top, ())]
+
+    while stack:
+        dirpath, rules = stack.pop()
+
+        try:
+            entries = list(_scandir(dirpath))
+        except OSError:
+            continue
+
+        names = set(entry.name for entry in entries)
+        for fn in ignore_files:
+            if fn in names:
+                ignore = IgnoreFile.read(os.path.join(dirpath, fn))
+                if ignore.rules:
+                    rules = rules + (ignore,)
+
+        files = []
+        dirs = []
+        for entry in entries:
+            name = entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if not hidden and name.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, name)
+                if ignore_dir is not None and ignore_dir(path):
+                    continue
+                if rules and _ignored(rules, path, True):
+                    continue
+                dirs.append((name, path))
+            elif name.endswith(extensions):
+                path = os.path.join(dirpath, name)
+                if rules and _ignored(rules, path, False):
+                    continue
+                if entry.is_file():
+                    files.append((name, path))
+
+        files.sort()
+        for name, path in files:
+            yield path
+
+        dirs.sort(reverse=True)
+        for name, path in dirs:
+            stack.append((path, rules))
+
+
+class GitError(Exception):
+    pass
+
+
+def git_files(paths, extensions=('.py',), changed_since=None,
+              ignore_dir=None, hidden=False):
+    # files tracked by the git repository of the current directory under
+    # the given paths, or only those changed since a revision (including
+    # untracked ones), relative to the current directory
+    cwd = os.path.realpath(os.getcwd())
+    paths = [os.path.realpath(p) for p in paths]
+
+    if changed_since is not None:
+        top, names = _git_changed(changed_since)
+    else:
+        top, names = _git_ls_files()
+
+    for name in names:
+        if not name.endswith(extensions):
+            continue
+
+        path = os.path.join(top, *name.split('/'))
+        for p in paths:
+            if path == p or path.startswith(os.path.join(p, '')):
+                break
+        else:
+            continue
+
+        # hidden directories are the ones below the path searched
+        if not hidden and any(part.startswith('.') for part in
+                              os.path.relpath(path, p).split(os.sep)[:-1]):
+            continue
+
+        path = os.path.relpath(path, cwd)
+        dirname = os.path.dirname(path)
+        if dirname and ignore_dir is not None and ignore_dir(dirname):
+            continue
+
+        if os.path.isfile(path):
+            yield path
+
+
+def _git(*args):
+    # output of a git command, None if git is not installed
+    import subprocess
+
+    try:
+        proc = subprocess.Popen(('git',) + args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    except OSError:
+        return None
+
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise GitError(_decode(err).strip() or
+                       'git {} failed'.format(args[0]))
+    return out
+
+
+def _git_toplevel():
+    out = _git('rev-parse', '--show-toplevel')
+    if out is None:
+        return None
+    return os.path.realpath(_decode(out).strip())
+
+
+def _git_ls_files():
+    top = _git_toplevel()
+    if top is None:
+        # no git executable, the index is read directly
+        gitdir = find_git_dir(os.getcwd())
+        if gitdir is None:
+            raise GitError('not a git repository')
+        return (os.path.realpath(os.path.dirname(gitdir)),
+                read_git_index(os.path.join(gitdir, 'index')))
+
+    out = _git('-C', top, 'ls-files', '-z')
+    return top, _split(out)
+
+
+def _git_changed(rev):
+    top = _git_toplevel()
+    if top is None:
+        raise GitError('git is required to find files changed since a '
+                       'revision')
+
+    changed = _split(_git('-C', top, 'diff', '--name-only', '-z',
+                          '--diff-filter=d', rev, '--'))
+    untracked = _split(_git('-C', top, 'ls-files', '-z', '--others',
+                            '--exclude-standard'))
+    return top, sorted(set(changed) | set(untracked))
+
+
+def _split(out):
+    return [_decode(name) for name in out.split(b'\0') if name]
+
+
+def _decode(name):
+    if sys.version_info[0] < 3:
+        return name
+    return os.fsdecode(name)
+
+
+def find_git_dir(path):
+    # the .git directory of the repository containing path, following .git
+    # files of worktrees and submodules
+    path = os.path.abspath(path)
+    while True:
+        gitdir = os.path.join(path, '.git')
+        if os.path.isdir(gitdir):
+            return gitdir
+        if os.path.isfile(gitdir):
+            with open(gitdir) as fp:
+                line = fp.readline().strip()
+            if line.startswith('gitdir:'):
+                return os.path.join(path, line[len('gitdir:'):].strip())
+
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def read_git_index(filename):
+    # paths of the files in a git index file (versions 2 to 4), as stored:
+    # relative to the top of the work tree and separated by slashes
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+
+    if data[:4] != b'DIRC':
+        raise GitError('{}: not a git index'.format(filename))
+
+    version, count = struct.unpack('>II', data[4:12])
+    if version not in (2, 3, 4):
+        raise GitError('{}: unsupported index version {}'.format(
+            filename, version))
+
+    names = []
+    pos = 12
+    name = b''
+    for i in range(count):
+        mode, = struct.unpack('>I', data[pos + 24:pos + 28])
+        flags, = struct.unpack('>H', data[pos + 60:pos + 62])
+        start = pos + 62
+        if flags & 0x4000:
+            # extended flags, version 3 and above
+            start += 2
+
+        if version == 4:
+            # the length of the end of the previous path to drop, followed
+            # by what comes after it
+            strip, start = _varint(data, start)
+            end = data.index(b'\0', start)
+            name = name[:len(name) - strip] + data[start:end]
+            pos = end + 1
+        else:
+            end = data.index(b'\0', start)
+            name = data[start:end]
+            # entries are padded with NULs to a multiple of 8 bytes
+            pos += (end - pos + 8) & ~7
+
+        # skip submodules, conflicting files have an entry per stage
+        if mode & 0o170000 != 0o160000:
+            path = _decode(name)
+            if not names or names[-1] != path:
+                names.append(path)
+
+    return names
+
+
+def _varint(data, pos):
+    # git's offset encoding: 7 bits per byte, adding one on continuation
+    c = _byte(data, pos)
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = _byte(data, pos)
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, pos
+
+
+def _byte(data, pos):
+    return ord(data[pos:pos + 1])
+
+
+def _ignored(rules, path, is_dir):
+    # the rules of the innermost ignore file with a matching pattern win
+    for ignore in reversed(rules):
+        ignored = ignore.match(path, is_dir)
+        if ignored is not None:
+            return ignored
+    return False
+
+
+class IgnoreFile(object):
+    # patterns of a .gitignore file, matched against paths under its
+    # directory; the last matching pattern decides, as with git
+    def __init__(self, base, lines):
+        self.base = os.path.join(base, '')
+        self.rules = []
+
+        for line in lines:
+            line = line.rstrip('\n').rstrip('\r')
+            if not line.endswith('\\ '):
+                line = line.rstrip(' ')
+            if not line or line.startswith('#'):
+                continue
+
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            elif line.startswith('\\'):
+                line = line[1:]
+
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+
+            self.rules.append((compile_pattern(line), negate, dir_only))
+
+        # without negations a single regex tells whether a path is ignored
+        self.regexes = None
+        if not any(negate for _, negate, _ in self.rules):
+            self.regexes = (
+                _join([r for r, _, dir_only in self.rules if not dir_only]),
+                _join([r for r, _, dir_only in self.rules]),
+            )
+
+    @classmethod
+    def read(cls, filename):
+        try:
+            with open(filename) as fp:
+                lines = fp.readlines()
+        except (IOError, OSError, UnicodeError):
+            lines = []
+        return cls(os.path.dirname(filename), lines)
+
+    def match(self, path, is_dir):
+        # True if ignored, False if re-included and None if no pattern
+        # matches
+        if not path.startswith(self.base):
+            return None
+        path = path[len(self.base):]
+        if os.sep != '/':
+            path = path.replace(os.sep, '/')
+
+        if self.regexes is not None:
+            regex = self.regexes[is_dir]
+            if regex is not None and regex.match(path):
+                return True
+            return None
+
+        for regex, negate, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(path):
+                return not negate
+        return None
+
+
+def compile_pattern(pattern):
+    # a gitignore pattern as a regex matching paths relative to the
+    # directory of the ignore file, patterns without a slash match names at
+    # any depth
+    if '/' in pattern:
+        pattern = pattern.lstrip('/')
+        prefix = ''
+    else:
+        prefix = '(?:.*/)?'
+
+    i, n = 0, len(pattern)
+    regex = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('/**', i) and i + 3 == n:
+            regex.append('/.*')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+
+        if c == '*':
+            regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c == '[':
+            j = pattern.find(']', i + 2 if pattern[i + 1:i + 2] in '!]'
+                             else i + 1)
+            if j == -1:
+                regex.append(r'\[')
+            else:
+                chars = pattern[i + 1:j].replace('\\', r'\\')
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex.append('[{}]'.format(chars))
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        else:
+            regex.append(re.escape(c))
+        i += 1
+
+    return re.compile(prefix + ''.join(regex) + r'\Z', re.S)
+
+
+def _join(regexes):
+    if not regexes:
+        return None
+    return re.compile('|'.join(
+        '(?:{})'.format(regex.pattern) for regex in regexes), re.S)
+
+
+class _Entry(object):
+    # the parts of os.DirEntry used by walk, for Python < 3.5
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+
+    def is_dir(self, follow_symlinks=True):
+        if not follow_symlinks and os.path.islink(self.path):
+            return False
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+
+def _scandir(dirpath):
+    if scandir is not None:
+        return scandir(dirpath)
+    return [_Entry(dirpath, name) for name in os.listdir(dirpath)]
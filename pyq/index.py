@@ -0,0 +1,271 @@
+import os
+
+from collections import namedtuple
+from itertools import groupby
+from operator import itemgetter
+
+from .astmatch import ASTMatchEngine, PARSE_ERRORS, compare
+
+
+DEFAULT_INDEX_FILE = '.pyqindex'
+
+# types and attributes whose values are recorded in the index, selectors
+# using anything else are matched against the AST
+TYPES = ('class', 'def', 'import', 'assign', 'call', 'attr')
+ATTRS = ('from', 'full', 'name', 'kwarg', 'arg')
+
+# bumped whenever the tables change, older index files are emptied and have
+# to be built again
+SCHEMA_VERSION = 2
+
+DROP_SCHEMA = '''
+DROP TABLE IF EXISTS attrs;
+DROP TABLE IF EXISTS nodes;
+DROP TABLE IF EXISTS files;
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    file INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    cls TEXT NOT NULL,
+    name TEXT,
+    lineno INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    end_lineno INTEGER,
+    end_col INTEGER
+);
+CREATE TABLE IF NOT EXISTS attrs (
+    node INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS nodes_file_type ON nodes (file, type);
+CREATE INDEX IF NOT EXISTS attrs_node ON attrs (node);
+'''
+
+
+IndexedNode = namedtuple(
+    'IndexedNode', 'cls name lineno col_offset end_lineno end_col_offset')
+
+
+class SymbolIndex(object):
+    def __init__(self, path=DEFAULT_INDEX_FILE, engine=None):
+        self.path = path
+        import sqlite3
+
+        self.engine = engine or ASTMatchEngine()
+        self.db = sqlite3.connect(path)
+
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.db.executescript(DROP_SCHEMA)
+            self.db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM attrs')
+            self.db.execute('DELETE FROM nodes')
+            self.db.execute('DELETE FROM files')
+
+    def update(self, filenames):
+        updated = 0
+
+        with self.db:
+            for filename in filenames:
+                path = os.path.abspath(filename)
+                st = os.stat(path)
+                mtime = _mtime(st)
+
+                row = self.db.execute(
+                    'SELECT id, mtime, size FROM files WHERE path = ?',
+                    (path,)).fetchone()
+
+                if row is not None:
+                    if row[1:] == (mtime, st.st_size):
+                        continue
+                    self._remove(row[0])
+
+                try:
+                    module = self.engine.parse(path)
+                except PARSE_ERRORS:
+                    # left out of the index, searches will parse it again
+                    continue
+
+                cursor = self.db.execute(
+                    'INSERT INTO files (path, mtime, size) VALUES (?, ?, ?)',
+                    (path, mtime, st.st_size))
+                self._add_nodes(cursor.lastrowid, module)
+                updated += 1
+
+        return updated
+
+    def prune(self):
+        # forget files that do not exist anymore
+        removed = 0
+
+        with self.db:
+            for file_id, path in self.db.execute(
+                    'SELECT id, path FROM files').fetchall():
+                if not os.path.exists(path):
+                    self._remove(file_id)
+                    removed += 1
+
+        return removed
+
+    def answerable(self, selectors):
+        selectors = self.engine.compile(selectors)
+        return all(self._answerable(selector) for selector in selectors)
+
+    def _answerable(self, selector):
+        if selector.next_selector or selector.combinator or \
+                selector.classes or selector.typ not in TYPES:
+            return False
+
+        if any(lft not in ATTRS for lft, op, rgt in selector.attrs):
+            return False
+
+        for name, value in selector.pseudos:
+            if name != 'extends':
+                return False
+
+            # only :extends() and :extends(#name, ...)
+            for base in self.engine.parse_selector(value):
+                if base.typ or base.attrs or base.pseudos or base.classes \
+                        or base.next_selector or not base.id_:
+                    return False
+
+        return True
+
+    def match(self, selectors, filename):
+        # matches of an answerable selector, or None if the file is not
+        # indexed or has changed since it was indexed
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+
+        row = self.db.execute(
+            'SELECT id, mtime, size FROM files WHERE path = ?',
+            (path,)).fetchone()
+
+        if row is None or row[1:] != (_mtime(st), st.st_size):
+            return None
+
+        selectors = self.engine.compile(selectors)
+        matches = []
+        seen = set()
+
+        for selector in selectors:
+            for seq, node in self._match_selector(selector, row[0]):
+                if seq not in seen:
+                    seen.add(seq)
+                    matches.append((node, node.lineno))
+
+        return matches
+
+    def _match_selector(self, selector, file_id):
+        rows = self.db.execute(
+            'SELECT n.id, n.seq, n.cls, n.name, n.lineno, n.col, '
+            'n.end_lineno, n.end_col, a.key, a.value '
+            'FROM nodes n LEFT JOIN attrs a ON a.node = n.id '
+            'WHERE n.file = ? AND n.type = ? ORDER BY n.seq',
+            (file_id, selector.typ))
+
+        # one row per attribute of a node, the rows of a node follow each
+        # other
+        for node_id, node_rows in groupby(rows, itemgetter(0)):
+            node_rows = list(node_rows)
+            values = {}
+            for row in node_rows:
+                if row[8] is not None:
+                    values.setdefault(row[8], []).append(row[9])
+            if self._match_values(selector, values):
+                first = node_rows[0]
+                yield first[1], IndexedNode(*first[2:8])
+
+    def _match_values(self, selector, values):
+        if selector.id_ and selector.id_ not in values.get('id', ()):
+            return False
+
+        for lft, op, rgt in selector.attrs:
+            if not compare(op, values.get(lft, ()), rgt):
+                return False
+
+        for name, value in selector.pseudos:
+            if not value:
+                if 'nobases' not in values:
+                    return False
+            elif not any(base.id_ in values.get('base', ())
+                         for base in self.engine.parse_selector(value)):
+                return False
+
+        return True
+
+    def _add_nodes(self, file_id, module):
+        m = self.engine
+
+        for seq, node in enumerate(_walk(m, module.body)):
+            typ = self._node_type(node)
+            if typ is None:
+                continue
+
+            cursor = self.db.execute(
+                'INSERT INTO nodes (file, seq, type, cls, name, lineno, col, '
+                'end_lineno, end_col) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (file_id, seq, typ, type(node).__name__, m.node_name(node),
+                 m.node_lineno(node), node.col_offset,
+                 getattr(node, 'end_lineno', None),
+                 getattr(node, 'end_col_offset', None)))
+            node_id = cursor.lastrowid
+
+            values = [('id', value) for value in m.id_values(node)]
+            for lft in ATTRS:
+                values.extend(
+                    (lft, value) for value in m.attr_values(lft, node))
+
+            if typ == 'class':
+                if not node.bases:
+                    values.append(('nobases', None))
+                for base in _walk(m, node.bases):
+                    values.extend(('base', value)
+                                  for value in m.id_values(base))
+
+            self.db.executemany(
+                'INSERT INTO attrs (node, key, value) VALUES (?, ?, ?)',
+                [(node_id, key, value) for key, value in values])
+
+    def _node_type(self, node):
+        for typ in TYPES:
+            if self.engine.match_type(typ, node):
+                return typ
+
+    def _remove(self, file_id):
+        self.db.execute(
+            'DELETE FROM attrs WHERE node IN '
+            '(SELECT id FROM nodes WHERE file = ?)', (file_id,))
+        self.db.execute('DELETE FROM nodes WHERE file = ?', (file_id,))
+        self.db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+
+def _walk(m, data):
+    # nodes in the same order they are visited by MatchEngine.match_data
+    for node, body in m.iter_data(data):
+        yield node
+        if body:
+            for n in _walk(m, body):
+                yield n
+
+
+def _mtime(st):
+    return getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))
@@ -0,0 +1,306 @@
+import itertools
+import json
+
+from collections import namedtuple
+
+from .index import IndexedNode
+
+
+FORMATS = ('text', 'json', 'ndjson', 'tsv')
+COLORS = ('auto', 'always', 'never')
+
+# one record per match, end positions are None when the parser does not
+# provide them (Python < 3.8)
+Match = namedtuple('Match', 'path line col end_line end_col type name')
+
+# records of --rules, tagged with the id of the rule that matched
+RuleMatch = namedtuple('RuleMatch', Match._fields + ('rule',))
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def match_records(m, filename, matches):
+    for node, lineno in matches:
+        yield Match(*_fields(m, filename, node, lineno))
+
+
+def rule_records(m, filename, matches):
+    for rule, node, lineno in matches:
+        yield RuleMatch(*_fields(m, filename, node, lineno) + (rule,))
+
+
+def _fields(m, filename, node, lineno):
+    if isinstance(node, IndexedNode):
+        typ, name = node.cls, node.name
+    else:
+        typ, name = type(node).__name__, m.node_name(node)
+
+    return (filename, lineno, node.col_offset,
+            getattr(node, 'end_lineno', None),
+            getattr(node, 'end_col_offset', None),
+            typ, name)
+
+
+def writer(fmt, stream, **options):
+    return WRITERS[fmt](stream, **options)
+
+
+def line_key(fmt, expand=False, rules=False):
+    # what tells results shown on separate lines apart, None if each result
+    # is shown (text lines are (line, lineno, col[, rule]))
+    if fmt != 'text' or expand:
+        return None
+    if rules:
+        return lambda result: (result[1], result[3])
+    return lambda result: result[1]
+
+
+def first(results, count, key=None):
+    # the results up to the count-th one shown (see line_key), so that the
+    # search stops as soon as the last one is found
+    if key is None:
+        return itertools.islice(results, count)
+    return _first_keys(results, count, key)
+
+
+def _first_keys(results, count, key):
+    if count < 1:
+        return
+    seen = set()
+    for result in results:
+        k = key(result)
+        if k not in seen:
+            seen.add(k)
+        yield result
+        if len(seen) == count:
+            return
+
+
+class _Limits(object):
+    # -m/--max-count and --max-total: results shown per file and overall
+    def __init__(self, max_count=None, max_total=None):
+        self.max_count = max_count
+        self.max_total = max_total
+        self.written = 0
+
+    def limit(self):
+        # results the next file can show, None if not limited
+        if self.max_total is None:
+            return self.max_count
+        left = max(0, self.max_total - self.written)
+        if self.max_count is None:
+            return left
+        return min(self.max_count, left)
+
+    @property
+    def done(self):
+        return self.max_total is not None and self.written >= self.max_total
+
+
+class TextWriter(_Limits):
+    # grep-like lines, highlighted when color is enabled; output is buffered
+    # and written in large chunks, or after every file on a terminal
+    max_highlighted = 10000
+    buffer_size = 64 * 1024
+
+    def __init__(self, stream, color='auto', files_only=False, expand=False,
+                 rules=False, max_count=None, max_total=None):
+        super(TextWriter, self).__init__(max_count, max_total)
+        self.stream = stream
+        self.files_only = files_only
+        self.expand = expand
+        self.rules = rules
+        # -l is given the matches themselves, the first one is enough
+        self.key = None if files_only else line_key('text', expand, rules)
+
+        isatty = getattr(stream, 'isatty', None)
+        tty = isatty is not None and isatty()
+        if color == 'auto':
+            color = 'always' if tty else 'never'
+        self.color = color == 'always'
+
+        # Pygments is only imported when highlighting
+        self.highlight = None
+        self.highlighted = {}
+
+        self.buffer = []
+        self.buffered = 0
+        self.max_buffered = 0 if tty else self.buffer_size
+
+    def write(self, filename, matches):
+        limit = self.limit()
+        if limit is not None:
+            matches = first(matches, limit, self.key)
+
+        if self.files_only:
+            for match in matches:
+                self._write([filename + '\n'])
+                self.written += 1
+                break
+            return
+
+        if self.rules:
+            self.write_rules(filename, matches)
+            return
+
+        out = []
+        lines = {}
+        for line, no, col in matches:
+            if not self.expand:
+                if no in lines:
+                    continue
+                lines[no] = True
+                out.append('{}:{}  {}'.format(filename, no,
+                                              self.render(line)))
+            else:
+                out.append('{}:{}:{}  {}'.format(filename, no, col,
+                                                 self.render(line)))
+
+        if out:
+            self.written += len(out)
+            self._write(out)
+
+    def write_rules(self, filename, matches):
+        # lines prefixed by the rule id, a line is shown once per rule
+        out = []
+        lines = {}
+        for line, no, col, rule in matches:
+            if not self.expand:
+                if (no, rule) in lines:
+                    continue
+                lines[no, rule] = True
+                out.append('{}:{}  [{}]  {}'.format(filename, no, rule,
+                                                    self.render(line)))
+            else:
+                out.append('{}:{}:{}  [{}]  {}'.format(filename, no, col, rule,
+                                                       self.render(line)))
+
+        if out:
+            self.written += len(out)
+            self._write(out)
+
+    def _write(self, out):
+        self.buffer.extend(out)
+        self.buffered += sum(len(text) for text in out)
+        if self.buffered > self.max_buffered:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        self.stream.flush()
+
+    def render(self, line):
+        line = line.strip()
+        if not self.color:
+            return line + '\n'
+
+        # lines are highlighted one at a time, as joining them would let an
+        # unterminated string on one line color the following ones
+        try:
+            return self.highlighted[line]
+        except KeyError:
+            pass
+
+        if self.highlight is None:
+            self.highlight = _highlighter()
+
+        if len(self.highlighted) >= self.max_highlighted:
+            self.highlighted.clear()
+        text = self.highlighted[line] = self.highlight(line)
+        return text
+
+    def close(self):
+        self.flush()
+
+
+def _highlighter():
+    from pygments import highlight
+    from pygments.lexers.python import PythonLexer
+    from pygments.formatters.terminal import TerminalFormatter
+
+    lexer = PythonLexer()
+    formatter = TerminalFormatter()
+    return lambda line: highlight(line, lexer, formatter)
+
+
+class NDJSONWriter(_Limits):
+    # records are written as soon as they are given and the stream flushed
+    # after each file, so consumers can start before the search is over
+    def __init__(self, stream, max_count=None, max_total=None, **options):
+        super(NDJSONWriter, self).__init__(max_count, max_total)
+        self.stream = stream
+
+    def records(self, records):
+        limit = self.limit()
+        if limit is not None:
+            records = first(records, limit)
+        for record in records:
+            self.written += 1
+            yield record
+
+    def write(self, filename, records):
+        write = self.stream.write
+        encode = _encoder.encode
+        for record in self.records(records):
+            write(encode(record._asdict()))
+            write('\n')
+        self.stream.flush()
+
+    def close(self):
+        self.stream.flush()
+
+
+class JSONWriter(NDJSONWriter):
+    # a single array, with one record per line
+    def __init__(self, stream, **options):
+        super(JSONWriter, self).__init__(stream, **options)
+        self.empty = True
+
+    def write(self, filename, records):
+        write = self.stream.write
+        encode = _encoder.encode
+        for record in self.records(records):
+            write(',\n' if not self.empty else '[\n')
+            self.empty = False
+            write(encode(record._asdict()))
+        self.stream.flush()
+
+    def close(self):
+        self.stream.write('[]\n' if self.empty else '\n]\n')
+        self.stream.flush()
+
+
+class TSVWriter(NDJSONWriter):
+    # fields in the order of Match (or RuleMatch), missing values left empty
+    def write(self, filename, records):
+        write = self.stream.write
+        for record in self.records(records):
+            write('\t'.join('' if value is None else str(value)
+                            for value in record))
+            write('\n')
+        self.stream.flush()
+
+
+class QuietWriter(_Limits):
+    # -q/--quiet, nothing is shown and the search stops at the first match
+    def __init__(self, stream=None, **options):
+        super(QuietWriter, self).__init__(max_total=1)
+
+    def write(self, filename, matches):
+        for match in matches:
+            self.written += 1
+            break
+
+    def close(self):
+        pass
+
+
+WRITERS = {
+    'text': TextWriter,
+    'json': JSONWriter,
+    'ndjson': NDJSONWriter,
+    'tsv': TSVWriter,
+}
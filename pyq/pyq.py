@@ -1,105 +1,653 @@
 import click
+import collections
+import itertools
 import os
+import sys
+import threading
 
+try:
+    import queue
+except ImportError:  # Python 2.x
+    import Queue as queue
+
+# modules only needed by some options (pygments, sqlite3, multiprocessing,
+# the parse cache, ...) are imported when used, as importing them can take
+# longer than a small search
+from . import files
 from .astmatch import ASTMatchEngine
-from pygments import highlight
-from pygments.lexers.python import PythonLexer
-from pygments.formatters.terminal import TerminalFormatter
+from .index import SymbolIndex, DEFAULT_INDEX_FILE
+from .output import COLORS, FORMATS, QuietWriter, first, line_key, \
+    match_records, rule_records, writer
+from .rules import RulesError, load_rules
+from sizzle.selector import SelectorSyntaxError
+
+
+class DefaultGroup(click.Group):
+    # runs the default command when the first argument is not the name of
+    # another command, so `pyq SELECTOR` keeps working next to `pyq index`
+    def __init__(self, *args, **kwargs):
+        self.default_command = kwargs.pop('default_command')
+        super(DefaultGroup, self).__init__(*args, **kwargs)
+
+    def parse_args(self, ctx, args):
+        if not args or args[0] not in self.commands:
+            args = [self.default_command] + list(args)
+        return super(DefaultGroup, self).parse_args(ctx, args)
 
 
-@click.command()
-@click.argument('selector')
+@click.group(cls=DefaultGroup, default_command='search')
+def main():
+    pass
+
+
+@main.command(epilog='Other commands: index, serve (see `COMMAND --help`).')
+@click.argument('selector', required=False)
 @click.option('-l/--files', is_flag=True,
               help='Only print filenames containing matches.')
+@click.option('-m', '--max-count', type=click.IntRange(0), metavar='NUM',
+              help='Stop searching a file after NUM matching lines (or '
+                   'records with --format).')
+@click.option('--max-total', type=click.IntRange(0), metavar='NUM',
+              help='Stop searching after NUM matching lines (or records, or '
+                   'files with -l) overall.')
+@click.option('-q', '--quiet', is_flag=True, default=False,
+              help='Print nothing and stop at the first match, exiting with '
+                   'status 0 if anything matched and 1 otherwise.')
 @click.option('--ignore-dir', multiple=True,
               help='Ignore directory.')
 @click.option('-n/--no-recurse', is_flag=True, default=False,
               help='No descending into subdirectories.')
+@click.option('--hidden', is_flag=True, default=False,
+              help='Search hidden directories.')
+@click.option('--no-ignore', is_flag=True, default=False,
+              help='Do not skip files matching .gitignore and .pyqignore '
+                   'patterns.')
+@click.option('--git', is_flag=True, default=False,
+              help='Search the files tracked by git instead of walking '
+                   'directories.')
+@click.option('--changed-since', metavar='REV',
+              help='Only search files changed since a git revision '
+                   '(implies --git).')
+@click.option('--rules', 'rules_file', type=click.Path(dir_okay=False),
+              metavar='FILE',
+              help='Match all the selectors of a YAML or JSON rules file in a '
+                   'single pass, tagging matches with their rule id (the '
+                   'SELECTOR argument is then taken as a PATH).')
 @click.option('-e/--expand', is_flag=True, default=False,
               help='Show multiple matches in the same line.')
+@click.option('-j', '--jobs', type=int, default=1,
+              help='Number of processes used to scan files (0 for one per '
+                   'CPU).')
+@click.option('--prefetch', type=int, default=8, metavar='DEPTH',
+              help='Number of files read ahead by background threads '
+                   '(0 to disable).')
+@click.option('--unordered', is_flag=True, default=False,
+              help='Print results as soon as they are found when using '
+                   'multiple jobs.')
+@click.option('--cache/--no-cache', default=None,
+              help='Cache parsed files between runs.')
+@click.option('--cache-dir', type=click.Path(file_okay=False),
+              help='Cache directory (implies --cache).')
+@click.option('--index', 'index_file', type=click.Path(dir_okay=False),
+              help='Answer queries from a symbol index when possible.')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='text',
+              metavar='FORMAT',
+              help='Output format: text (default), json, ndjson or tsv.')
+@click.option('--color', type=click.Choice(COLORS), default='auto',
+              metavar='WHEN',
+              help='Highlight matching lines: auto (default, only on a '
+                   'terminal), always or never.')
+@click.option('--stats', is_flag=True, default=False,
+              help='Print the time spent in each phase of the search, '
+                   'counters and the slowest files to stderr (files '
+                   'matched by --jobs workers are not counted).')
+@click.option('--stats-json', is_flag=True, default=False,
+              help='Print the --stats as JSON.')
+@click.option('--profile', type=click.Path(dir_okay=False), metavar='FILE',
+              help='Run the search under cProfile and save its stats to '
+                   'FILE.')
 @click.argument('path', nargs=-1)
 @click.pass_context
-def main(ctx, selector, path, **opts):
-    m = ASTMatchEngine()
+def search(ctx, selector, path, **opts):
+    stats = None
+    if opts['stats'] or opts['stats_json']:
+        from .stats import Stats
+        stats = Stats()
+
+    profiler = None
+    if opts['profile']:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        run_search(ctx, selector, path, opts, stats)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(opts['profile'])
+        if stats is not None:
+            stats.report(sys.stderr, opts['stats_json'])
+
+
+def run_search(ctx, selector, path, opts, stats=None):
+    if opts['fmt'] != 'text' and opts['l']:
+        ctx.fail('-l can only be used with --format=text')
+
+    cache = None
+    if opts['cache'] or (opts['cache_dir'] and opts['cache'] is None):
+        from .cache import ParseCache
+        cache = ParseCache(opts['cache_dir'])
+
+    m = ASTMatchEngine(cache=cache, on_error=parse_error)
+    if stats is not None:
+        stats.instrument(m)
+
+    rules = None
+    if opts['rules_file']:
+        if selector is not None:
+            path = (selector,) + path
+        rules = compile_rules(ctx, m, opts['rules_file'])
+    elif selector is None:
+        raise click.MissingParameter(ctx=ctx, param_hint='"selector"',
+                                     param_type='argument')
+    else:
+        try:
+            m.compile(selector)
+        except SelectorSyntaxError as e:
+            ctx.fail(syntax_error(e))
 
     if len(path) == 0:
         path = ['.']
 
+    if opts['quiet']:
+        out = QuietWriter()
+    else:
+        out = writer(opts['fmt'], sys.stdout, color=opts['color'],
+                     files_only=opts['l'], expand=opts['e'],
+                     rules=rules is not None, max_count=opts['max_count'],
+                     max_total=opts['max_total'])
+
+    # -l and -q only need to know whether a file matches, so the lines of
+    # the matches are not read and matching stops at the first one
+    fmt = opts['fmt']
+    files_only = opts['l'] or opts['quiet']
+    if stats is not None:
+        stats.instrument_writer(out, 'search' if files_only else
+                                'lines' if fmt == 'text' else 'records')
+
     ignore_dir = (opts['ignore_dir'], not opts['n'])
-    for fn in walk_files(ctx, path, ignore_dir):
-        if fn.endswith('.py'):
-            display_matches(m, selector, os.path.relpath(fn), opts)
+    if opts['git'] or opts['changed_since']:
+        filenames = tracked_files(ctx, path, ignore_dir, opts['hidden'],
+                                  opts['changed_since'])
+    else:
+        filenames = (os.path.relpath(fn)
+                     for fn in walk_files(ctx, path, ignore_dir,
+                                          opts['hidden'],
+                                          not opts['no_ignore']))
+    if stats is not None:
+        filenames = stats.iterate('walk', filenames, 'files walked')
+
+    sources = prefetch(filenames, opts['prefetch'])
+    if stats is not None:
+        sources = stats.per_file(stats.iterate('read', sources))
+
+    jobs = opts['jobs']
+    if jobs < 1:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+
+    idx = None
+    if opts['index_file'] and rules is None and \
+            os.path.exists(opts['index_file']):
+        idx = SymbolIndex(opts['index_file'], m)
+        if not idx.answerable(selector):
+            idx.close()
+            idx = None
+
+    # whatever was found is written out even if the search fails, files
+    # left once the writer has shown all it can are not searched
+    try:
+        if out.done:
+            pass
+        elif idx is not None:
+            # files that are not indexed or changed since are matched as
+            # usual, reading them once
+            selector = m.compile(selector)
+            for fn in filenames:
+                source = None
+                matches = idx.match(selector, fn)
+                if matches is None:
+                    source = _read_file(fn)
+                    matches = m.match(selector, fn, source)
+                out.write(fn, results(m, fn, matches, fmt, source,
+                                      files_only))
+                if out.done:
+                    break
+            idx.close()
+        elif jobs > 1:
+            # the list of files is built upfront so errors raised while
+            # walking happen here and not inside the pool's feeder thread;
+            # workers stop at what a file can show, and the ones still
+            # running are terminated when the writer is done
+            filenames = list(filenames)
+            matches = parallel_matches(
+                selector, filenames, jobs, opts['unordered'], cache, fmt,
+                rules, opts['max_count'], opts['e'], files_only)
+            try:
+                for filename, found in matches:
+                    out.write(filename, found)
+                    if out.done:
+                        break
+            finally:
+                matches.close()
+        elif rules is not None:
+            for fn, source in sources:
+                matches = m.match_many(rules, fn, source)
+                out.write(fn, rule_results(m, fn, matches, fmt, source,
+                                           files_only))
+                if out.done:
+                    break
+        else:
+            selector = m.compile(selector)
+            for fn, source in sources:
+                display_matches(m, selector, fn, out, fmt, source,
+                                files_only)
+                if out.done:
+                    break
+    finally:
+        out.close()
+
+    if cache is not None:
+        cache.prune()
+
+    if opts['quiet']:
+        ctx.exit(0 if out.written else 1)
 
 
-def walk_files(ctx, paths, ignore_dir):
+@main.command()
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False),
+              help='Listen on a Unix socket instead of stdin/stdout.')
+@click.option('--poll', type=float, default=1.0, metavar='SECONDS',
+              show_default=True,
+              help='Interval between checks for changed files (0 to only '
+                   'check when asked to refresh).')
+@click.option('--hidden', is_flag=True, default=False,
+              help='Search hidden directories.')
+@click.option('--no-ignore', is_flag=True, default=False,
+              help='Do not skip files matching .gitignore and .pyqignore '
+                   'patterns.')
+@click.argument('path', nargs=-1)
+def serve(path, socket_path, poll, hidden, no_ignore):
+    """Answer JSON-RPC queries, keeping parsed files in memory."""
+    from .server import Server, Workspace
+
+    workspace = Workspace([click.format_filename(p) for p in path or ['.']],
+                          hidden=hidden, ignore_files=not no_ignore)
+    stats = workspace.refresh()
+    click.echo('{} files parsed'.format(stats['parsed']), err=True)
+
+    server = Server(workspace)
+    if poll > 0:
+        server.poll(poll)
+
+    if socket_path:
+        server.serve_unix(socket_path)
+    else:
+        server.serve_stdio()
+
+
+@main.group()
+def index():
+    """Manage the symbol index used by `search --index`."""
+
+
+@index.command()
+@click.option('-f', '--index-file', default=DEFAULT_INDEX_FILE,
+              type=click.Path(dir_okay=False), show_default=True,
+              help='Index file.')
+@click.argument('path', nargs=-1)
+@click.pass_context
+def build(ctx, path, index_file):
+    """Index all Python files under PATH from scratch."""
+    idx = SymbolIndex(index_file)
+    idx.clear()
+    count = idx.update(_index_files(ctx, path))
+    idx.close()
+    click.echo('{} files indexed'.format(count), err=True)
+
+
+@index.command()
+@click.option('-f', '--index-file', default=DEFAULT_INDEX_FILE,
+              type=click.Path(dir_okay=False), show_default=True,
+              help='Index file.')
+@click.argument('path', nargs=-1)
+@click.pass_context
+def update(ctx, path, index_file):
+    """Re-index files under PATH that changed since the last update."""
+    idx = SymbolIndex(index_file)
+    removed = idx.prune()
+    count = idx.update(_index_files(ctx, path))
+    idx.close()
+    click.echo('{} files indexed, {} removed'.format(count, removed),
+               err=True)
+
+
+def _index_files(ctx, path):
+    return walk_files(ctx, path or ['.'], ((), True))
+
+
+def walk_files(ctx, paths, ignore_dir, hidden=False, ignore_files=True):
+    def is_ignored(path):
+        return is_dir_ignored(os.path.normpath(path), *ignore_dir)
+
     for i, p in enumerate(paths):
         p = click.format_filename(p)
 
         if p == '.' or os.path.isdir(p):
-            for root, dirs, files in os.walk(p):
-                if is_dir_ignored(root.lstrip('./'), *ignore_dir):
-                    continue
-                for fn in files:
-                    yield os.path.join(root, fn)
+            if is_ignored(p):
+                continue
+            for fn in files.walk(p, ignore_dir=is_ignored, hidden=hidden,
+                                 ignore_files=files.IGNORE_FILES
+                                 if ignore_files else ()):
+                yield fn
 
         elif os.path.exists(p):
-            yield p
+            if p.endswith('.py'):
+                yield p
 
         elif i == 0:
             ctx.fail('{}: No such file or directory'.format(p))
             break
 
 
-def display_matches(m, selector, filename, opts):
-    matches = matching_lines(m.match(selector, filename), filename)
+def tracked_files(ctx, paths, ignore_dir, hidden=False, changed_since=None):
+    def is_ignored(path):
+        return is_dir_ignored(os.path.normpath(path), *ignore_dir)
+
+    paths = [click.format_filename(p) for p in paths]
+    if not os.path.exists(paths[0]):
+        ctx.fail('{}: No such file or directory'.format(paths[0]))
+
+    try:
+        # listed upfront so git errors are reported before any output
+        return list(files.git_files(paths, changed_since=changed_since,
+                                    ignore_dir=is_ignored, hidden=hidden))
+    except files.GitError as e:
+        ctx.fail(str(e))
+
+
+def compile_rules(ctx, m, filename):
+    try:
+        rules = load_rules(filename)
+    except RulesError as e:
+        ctx.fail(str(e))
+
+    compiled = []
+    for rule_id, selector in rules:
+        try:
+            compiled.append((rule_id, m.compile(selector)))
+        except SelectorSyntaxError as e:
+            ctx.fail('rule {}: {}'.format(rule_id, syntax_error(e)))
+    return m.compile_rules(compiled)
 
-    if opts.get('l'):
-        files = {}
-        for line, no, _ in matches:
-            if opts.get('l'):
-                if filename not in files:
-                    click.echo(filename)
-                    # do not repeat files
-                    files[filename] = True
 
+def parallel_matches(selector, filenames, jobs, unordered=False, cache=None,
+                     fmt='text', rules=None, limit=None, expand=False,
+                     files_only=False):
+    import multiprocessing
+
+    cache_dir = cache.directory if cache is not None else None
+    if rules is not None:
+        # workers compile the rules again from their selectors
+        rules = [(rule_id, group.source) for rule_id, group in rules]
+    pool = multiprocessing.Pool(
+        jobs, _init_worker,
+        (selector, cache_dir, fmt, rules, limit, expand, files_only))
+    try:
+        chunksize = max(1, min(64, len(filenames) // (jobs * 8)))
+        if unordered:
+            results = pool.imap_unordered(_match_file, filenames, chunksize)
+        else:
+            results = pool.imap(_match_file, filenames, chunksize)
+        for result in results:
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+_worker = None
+
+
+def _init_worker(selector, cache_dir, fmt, rules=None, limit=None,
+                 expand=False, files_only=False):
+    global _worker
+    cache = None
+    if cache_dir is not None:
+        from .cache import ParseCache
+        cache = ParseCache(cache_dir)
+    m = ASTMatchEngine(cache=cache, on_error=parse_error)
+    # -l and -q only need the first match of a file, as it is
+    if files_only:
+        limit = 1
+        key = None
+    else:
+        key = line_key(fmt, expand, rules is not None)
+    if rules is not None:
+        _worker = (m, None, fmt, m.compile_rules(rules), limit, key,
+                   files_only)
     else:
-        lines = {}
-        for line, no, col in matches:
-            text = highlight(line.strip(), PythonLexer(), TerminalFormatter())
-            if not opts['e']:
-                if no not in lines:
-                    lines[no] = True
-                    click.echo('{}:{}  {}'.format(filename, no, text),
-                               nl=False)
-            else:
-                click.echo('{}:{}:{}  {}'.format(filename, no, col, text),
-                           nl=False)
-
-
-def matching_lines(matches, filename):
-    fp = None
+        _worker = (m, m.compile(selector), fmt, None, limit, key, files_only)
+
+
+def _match_file(filename):
+    m, selector, fmt, rules, limit, key, files_only = _worker
+    if rules is not None:
+        found = rule_results(m, filename, m.match_many(rules, filename), fmt,
+                             files_only=files_only)
+    else:
+        found = results(m, filename, m.match(selector, filename), fmt,
+                        files_only=files_only)
+    if limit is not None:
+        found = first(found, limit, key)
+    return filename, list(found)
+
+
+def results(m, filename, matches, fmt='text', source=None, files_only=False):
+    # what the writers expect: lines of text, or records for the other
+    # formats, which never need the source; the matches themselves when
+    # only telling whether there are any
+    if files_only:
+        return matches
+    if fmt == 'text':
+        return matching_lines(matches, filename, source)
+    return match_records(m, filename, matches)
+
+
+def rule_results(m, filename, matches, fmt='text', source=None,
+                 files_only=False):
+    if files_only:
+        return matches
+    if fmt == 'text':
+        return rule_lines(matches, filename, source)
+    return rule_records(m, filename, matches)
+
+
+def display_matches(m, selector, filename, out, fmt='text', source=None,
+                    files_only=False):
+    matches = m.match(selector, filename, source)
+    out.write(filename, results(m, filename, matches, fmt, source,
+                                files_only))
+
+
+def prefetch(filenames, depth, threads=4):
+    # pairs of (filename, source), with the next depth files being read by a
+    # pool of threads while the current one is parsed and matched; source is
+    # None for files that could not be read, so the error is raised when
+    # they are read again by the caller
+    filenames = iter(filenames)
+    head = list(itertools.islice(filenames, 2))
+
+    if depth < 1 or len(head) < 2:
+        # no threads for a single file, its source is still read once for
+        # both parsing and its lines
+        for fn in itertools.chain(head, filenames):
+            yield fn, _read_file(fn)
+        return
+
+    pool = _Readers(min(depth, threads))
+    try:
+        pending = collections.deque()
+        for fn in itertools.chain(head, filenames):
+            pending.append(pool.read(fn))
+            if len(pending) > depth:
+                read = pending.popleft()
+                yield read.filename, read.get()
+
+        while pending:
+            read = pending.popleft()
+            yield read.filename, read.get()
+    finally:
+        pool.close()
+
+
+class _Readers(object):
+    # threads reading files, lighter to start than multiprocessing's
+    # ThreadPool
+    def __init__(self, threads):
+        self.queue = queue.Queue()
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def read(self, filename):
+        read = _Read(filename)
+        self.queue.put(read)
+        return read
+
+    def run(self):
+        while True:
+            read = self.queue.get()
+            if read is None:
+                break
+            read.source = _read_file(read.filename)
+            read.done.set()
+
+    def close(self):
+        # files not being read already are dropped
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        for thread in self.threads:
+            self.queue.put(None)
+
+
+class _Read(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.source = None
+        self.done = threading.Event()
+
+    def get(self):
+        self.done.wait()
+        return self.source
+
+
+def _read_file(filename):
+    try:
+        with open(filename, 'rb') as fp:
+            return fp.read()
+    except (IOError, OSError):
+        return None
+
+
+def matching_lines(matches, filename, source=None):
+    lines = None
     for match, lineno in matches:
-        if fp is None:
-            fp = open(filename, 'rb')
+        if lines is None:
+            if source is None:
+                with open(filename, 'rb') as fp:
+                    source = fp.read()
+            lines = SourceLines(source)
+
+        text = lines.get(lineno)
+        if text is not None:
+            yield text, lineno, match.col_offset
+
+
+def rule_lines(matches, filename, source=None):
+    # as matching_lines, for the (rule id, match, lineno) of --rules
+    lines = None
+    for rule, match, lineno in matches:
+        if lines is None:
+            if source is None:
+                with open(filename, 'rb') as fp:
+                    source = fp.read()
+            lines = SourceLines(source)
+
+        text = lines.get(lineno)
+        if text is not None:
+            yield text, lineno, match.col_offset, rule
+
+
+class SourceLines(object):
+    # line lookups over the raw bytes of a file, the offsets of all lines
+    # are computed once so any line can be sliced out directly
+    def __init__(self, source):
+        self.source = source
+
+        offsets = [0]
+        find = source.find
+        pos = find(b'\n')
+        while pos != -1:
+            pos += 1
+            offsets.append(pos)
+            pos = find(b'\n', pos)
+        self.offsets = offsets
+
+    def get(self, lineno):
+        offsets = self.offsets
+
+        if lineno < 1 or lineno > len(offsets):
+            return None
+
+        start = offsets[lineno - 1]
+        if start >= len(self.source):
+            return None
+
+        if lineno < len(offsets):
+            end = offsets[lineno]
         else:
-            fp.seek(0)
+            end = len(self.source)
 
-        i = 1
-        while True:
-            line = fp.readline()
+        # as with files declaring another encoding, or none but not
+        # encoded in UTF-8
+        return self.source[start:end].decode('utf-8', 'replace')
 
-            if not line:
-                break
 
-            if i == lineno:
-                text = line.decode('utf-8')
-                yield text, lineno, match.col_offset
-                break
+def parse_error(filename, e):
+    # files that cannot be parsed are reported and left out of the search
+    lineno = getattr(e, 'lineno', None)
+    message = getattr(e, 'msg', None) or str(e)
+    if lineno:
+        click.echo('{}:{}: {}'.format(filename, lineno, message), err=True)
+    else:
+        click.echo('{}: {}'.format(filename, message), err=True)
 
-            i += 1
 
-    if fp is not None:
-        fp.close()
+def syntax_error(e):
+    # the error followed by the selector with a caret under the position
+    return '{}\n\n  {}\n  {}^'.format(e.message, e.selector,
+                                      ' ' * e.position)
 
 
 def is_dir_ignored(path, ignore_dir, recurse):
@@ -0,0 +1,75 @@
+import json
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+class RulesError(Exception):
+    pass
+
+
+def load_rules(filename):
+    # (rule id, selector) pairs of a rules file, either a list of
+    # {id: ..., selector: ...} mappings or a mapping of ids to selectors,
+    # optionally under a top-level "rules" key; YAML needs PyYAML, JSON
+    # files are read either way
+    try:
+        with open(filename) as fp:
+            text = fp.read()
+    except (IOError, OSError) as e:
+        raise RulesError('{}: {}'.format(filename, e.strerror))
+
+    data = _parse(filename, text)
+
+    if isinstance(data, dict) and 'rules' in data:
+        data = data['rules']
+    if isinstance(data, dict):
+        data = [{'id': rule_id, 'selector': selector}
+                for rule_id, selector in data.items()]
+    if not isinstance(data, list):
+        raise RulesError('{}: expected a list or a mapping of rules'.format(
+            filename))
+
+    rules = []
+    ids = set()
+    for i, rule in enumerate(data):
+        if not isinstance(rule, dict) or 'selector' not in rule:
+            raise RulesError('{}: rule {} has no selector'.format(
+                filename, i + 1))
+
+        rule_id = str(rule.get('id', i + 1))
+        if rule_id in ids:
+            raise RulesError('{}: duplicate rule id {}'.format(
+                filename, rule_id))
+        ids.add(rule_id)
+
+        selector = rule['selector']
+        if not isinstance(selector, string_types):
+            raise RulesError('{}: rule {} has an invalid selector'.format(
+                filename, rule_id))
+        rules.append((rule_id, selector))
+
+    return rules
+
+
+def _parse(filename, text):
+    try:
+        import yaml
+    except ImportError:
+        yaml = None
+
+    if yaml is not None and not filename.endswith('.json'):
+        try:
+            return yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise RulesError('{}: {}'.format(filename, e))
+
+    try:
+        return json.loads(text)
+    except ValueError as e:
+        if yaml is None and filename.endswith(('.yaml', '.yml')):
+            raise RulesError('{}: PyYAML is required to read YAML '
+                             'rules'.format(filename))
+        raise RulesError('{}: {}'.format(filename, e))
@@ -0,0 +1,287 @@
+import inspect
+import json
+import os
+import sys
+import threading
+
+from . import files
+from .astmatch import ASTMatchEngine, PARSE_ERRORS
+from .output import match_records
+from .pyq import SourceLines
+
+try:
+    import socketserver
+except ImportError:  # Python 2.x
+    import SocketServer as socketserver
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+QUERY_ERROR = -32000
+
+
+class Workspace(object):
+    # the parsed modules of all Python files under some paths, kept in
+    # memory and parsed again only when their size or mtime change
+    def __init__(self, paths, engine=None, hidden=False, ignore_files=True):
+        self.paths = paths
+        self.engine = engine or ASTMatchEngine()
+        self.hidden = hidden
+        self.ignore_files = files.IGNORE_FILES if ignore_files else ()
+
+        # filename: ((mtime, size), source, module or None if it does not
+        # parse), filenames in walk order
+        self.modules = {}
+        self.filenames = []
+
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def walk(self):
+        for p in self.paths:
+            if os.path.isdir(p):
+                for fn in files.walk(p, hidden=self.hidden,
+                                     ignore_files=self.ignore_files):
+                    yield os.path.relpath(fn)
+            elif p.endswith('.py') and os.path.exists(p):
+                yield p
+
+    def refresh(self):
+        # a single refresh at a time, queries keep using the previous
+        # modules while files are parsed
+        with self.refresh_lock:
+            filenames = []
+            modules = {}
+            parsed = 0
+
+            for fn in self.walk():
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+
+                key = (getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size)
+                entry = self.modules.get(fn)
+                if entry is None or entry[0] != key:
+                    entry = self._parse(fn, key)
+                    if entry is None:
+                        continue
+                    parsed += 1
+
+                modules[fn] = entry
+                filenames.append(fn)
+
+            removed = len(set(self.modules) - set(modules))
+
+            with self.lock:
+                self.modules = modules
+                self.filenames = filenames
+
+            return {'files': len(filenames), 'parsed': parsed,
+                    'removed': removed}
+
+    def _parse(self, filename, key):
+        try:
+            with open(filename, 'rb') as fp:
+                source = fp.read()
+        except (IOError, OSError):
+            return None
+
+        try:
+            module = self.engine.parse(filename, source)
+        except PARSE_ERRORS:
+            module = None
+        return key, source, module
+
+    def search(self, selector, limit=None):
+        m = self.engine
+        results = []
+
+        with self.lock:
+            selector = m.compile(selector)
+            tokens = m.required_tokens(selector)
+
+            for fn in self.filenames:
+                key, source, module = self.modules[fn]
+                if module is None:
+                    continue
+                if tokens and not m.has_tokens(source, tokens):
+                    continue
+
+                lines = None
+                for record in match_records(m, fn, m.match_module(selector,
+                                                                  module)):
+                    if lines is None:
+                        lines = SourceLines(source)
+                    result = record._asdict()
+                    text = lines.get(record.line)
+                    result['text'] = text.strip() if text is not None \
+                        else None
+                    results.append(result)
+
+                    if limit is not None and len(results) >= limit:
+                        return results
+
+        return results
+
+
+class Server(object):
+    # JSON-RPC 2.0 requests, one per line, over stdin/stdout or a Unix
+    # socket; methods: search(selector, limit), refresh(), shutdown()
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.stopped = threading.Event()
+        self.methods = {
+            'search': self.search,
+            'refresh': self.refresh,
+            'shutdown': self.shutdown,
+        }
+
+    def search(self, selector, limit=None):
+        return self.workspace.search(selector, limit)
+
+    def refresh(self):
+        return self.workspace.refresh()
+
+    def shutdown(self):
+        self.stopped.set()
+        return None
+
+    def handle(self, line):
+        # the response to a line, None for notifications
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return _error(None, PARSE_ERROR, str(e))
+
+        if request == []:
+            return _error(None, INVALID_REQUEST, 'Invalid request')
+        if isinstance(request, list):
+            responses = [self.handle_request(r) for r in request]
+            return [r for r in responses if r is not None] or None
+
+        return self.handle_request(request)
+
+    def handle_request(self, request):
+        if not isinstance(request, dict) or \
+                request.get('jsonrpc') != '2.0' or \
+                not isinstance(request.get('method'), string_types):
+            return _error(None, INVALID_REQUEST, 'Invalid request')
+
+        response = self.call(request)
+        # notifications are never answered, not even errors
+        if 'id' not in request:
+            return None
+        return response
+
+    def call(self, request):
+        request_id = request.get('id')
+        method = self.methods.get(request['method'])
+        if method is None:
+            return _error(request_id, METHOD_NOT_FOUND,
+                          'Method not found: {}'.format(request['method']))
+
+        params = request.get('params', {})
+        if isinstance(params, list):
+            args, kwargs = params, {}
+        elif isinstance(params, dict):
+            args, kwargs = (), params
+        else:
+            return _error(request_id, INVALID_PARAMS,
+                          'params must be an array or an object')
+
+        # only the arguments are checked here, errors raised by the method
+        # are query errors whatever their type
+        try:
+            _bind(method, args, kwargs)
+        except TypeError as e:
+            return _error(request_id, INVALID_PARAMS, str(e))
+
+        try:
+            result = method(*args, **kwargs)
+        except Exception as e:
+            return _error(request_id, QUERY_ERROR, str(e))
+        return {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+
+    def poll(self, interval):
+        # refreshes the workspace in the background until stopped
+        def run():
+            while not self.stopped.wait(interval):
+                self.workspace.refresh()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def serve_stdio(self, stdin=None, stdout=None):
+        stdin = stdin or sys.stdin
+        stdout = stdout or sys.stdout
+
+        for line in iter(stdin.readline, ''):
+            if not line.strip():
+                continue
+            response = self.handle(line)
+            if response is not None:
+                stdout.write(json.dumps(response) + '\n')
+                stdout.flush()
+            if self.stopped.is_set():
+                break
+
+    def serve_unix(self, path):
+        server = self.unix_server(path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            self.stopped.wait()
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.remove(path)
+
+    def unix_server(self, path):
+        handle = self.handle
+        stopped = self.stopped
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in iter(self.rfile.readline, b''):
+                    if not line.strip():
+                        continue
+                    response = handle(line.decode('utf-8'))
+                    if response is not None:
+                        self.wfile.write(
+                            json.dumps(response).encode('utf-8') + b'\n')
+                        self.wfile.flush()
+                    if stopped.is_set():
+                        break
+
+        return _UnixServer(path, Handler)
+
+
+class _UnixServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _bind(method, args, kwargs):
+    # raises TypeError if method cannot be called with these arguments
+    signature = getattr(inspect, 'signature', None)
+    if signature is not None:
+        signature(method).bind(*args, **kwargs)
+    else:  # Python 2.x
+        inspect.getcallargs(method, *args, **kwargs)
+
+
+def _error(request_id, code, message):
+    return {'jsonrpc': '2.0', 'id': request_id,
+            'error': {'code': code, 'message': message}}
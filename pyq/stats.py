@@ -0,0 +1,176 @@
+import heapq
+import json
+
+from timeit import default_timer as clock
+
+
+class Stats(object):
+    # --stats: the wall time of each phase of a search, counters and the
+    # slowest files
+    #
+    # phases are exclusive, the time spent in a phase entered from another
+    # one (eg. traversal while parsing lines) only counts for the inner one,
+    # so the times add up to the duration of the search; nothing is measured
+    # unless a search is instrumented
+    def __init__(self, slowest=10):
+        self.times = {}
+        self.counters = {}
+        self.pseudos = {}
+        self.slowest = slowest
+        self.files = []
+
+        self.phase = 'other'
+        self.started = self.mark = clock()
+
+    def enter(self, phase):
+        # switches to phase, returning the phase to go back to
+        now = clock()
+        previous = self.phase
+        self.times[previous] = self.times.get(previous, 0) + now - self.mark
+        self.phase = phase
+        self.mark = now
+        return previous
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, phase, fn, counter=None):
+        def timed(*args, **kwargs):
+            if counter is not None:
+                self.count(counter)
+            previous = self.enter(phase)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.enter(previous)
+        return timed
+
+    def iterate(self, phase, items, counter=None):
+        # the items, produced in phase
+        items = iter(items)
+        while True:
+            previous = self.enter(phase)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.enter(previous)
+            if counter is not None:
+                self.count(counter)
+            yield item
+
+    def per_file(self, items):
+        # (filename, ...) items, the time until the next one is asked for
+        # being the time taken by the file
+        for item in items:
+            start = clock()
+            try:
+                yield item
+            finally:
+                self.file(item[0], clock() - start)
+
+    def file(self, filename, seconds):
+        entry = (seconds, filename)
+        if len(self.files) < self.slowest:
+            heapq.heappush(self.files, entry)
+        elif entry > self.files[0]:
+            heapq.heapreplace(self.files, entry)
+
+    def instrument(self, m):
+        # counts and times the work of a match engine, replacing its
+        # methods on the instance
+        m.parse = self.timed('parse', m.parse, 'files parsed')
+        m.match = self.searching(m.match)
+        m.match_many = self.searching(m.match_many)
+
+        iter_data = m.iter_data
+        m.iter_data = lambda data: self.iterate('traverse', iter_data(data),
+                                                'nodes visited')
+
+        predicate = m.predicate
+        m.predicate = lambda selector: self.timed('match',
+                                                  predicate(selector),
+                                                  'node tests')
+
+        # predicates compiled so far call the pseudos directly
+        m.pseudo_fns = dict((name, self.pseudo(name, fn))
+                            for name, fn in m.pseudo_fns.items())
+        m._predicates.clear()
+        m._rule_states.clear()
+
+    def searching(self, match):
+        def searching(*args, **kwargs):
+            self.count('files searched')
+            return self.iterate('search', match(*args, **kwargs), 'matches')
+        return searching
+
+    def pseudo(self, name, fn):
+        def pseudo(*args):
+            self.pseudos[name] = self.pseudos.get(name, 0) + 1
+            previous = self.enter('pseudo')
+            try:
+                return fn(*args)
+            finally:
+                self.enter(previous)
+        return pseudo
+
+    def instrument_writer(self, out, phase):
+        # phase is what producing the results given to the writer takes
+        # besides matching (eg. reading lines), the writer's own time is
+        # output, highlighting included unless it renders lines
+        write = out.write
+
+        def timed_write(filename, results):
+            previous = self.enter('output')
+            try:
+                write(filename, self.iterate(phase, results))
+            finally:
+                self.enter(previous)
+        out.write = timed_write
+
+        if hasattr(out, 'render'):
+            out.render = self.timed('render', out.render)
+
+    def result(self):
+        self.enter(self.phase)
+        counters = dict(self.counters)
+        if 'files searched' in counters:
+            counters['files skipped'] = counters['files searched'] - \
+                counters.get('files parsed', 0)
+
+        return {
+            'seconds': clock() - self.started,
+            'phases': dict(self.times),
+            'counters': counters,
+            'pseudos': dict(self.pseudos),
+            'slowest': [{'path': filename, 'seconds': seconds}
+                        for seconds, filename in sorted(self.files,
+                                                        reverse=True)],
+        }
+
+    def report(self, stream, as_json=False):
+        result = self.result()
+        if as_json:
+            stream.write(json.dumps(result, sort_keys=True) + '\n')
+            return
+
+        total = result['seconds']
+        lines = ['total {:>15.3f}s'.format(total)]
+        for phase, seconds in sorted(result['phases'].items(),
+                                     key=lambda item: -item[1]):
+            lines.append('  {:<10} {:>8.3f}s {:>5.1f}%'.format(
+                phase, seconds, 100.0 * seconds / total if total else 0))
+
+        for name, value in sorted(result['counters'].items()):
+            lines.append('{:<16} {}'.format(name, value))
+        for name, value in sorted(result['pseudos'].items()):
+            lines.append('{:<16} {}'.format(':{}()'.format(name), value))
+
+        if result['slowest']:
+            lines.append('slowest files')
+            for entry in result['slowest']:
+                lines.append('  {:>8.3f}s  {}'.format(entry['seconds'],
+                                                      entry['path']))
+
+        stream.write('\n'.join(lines) + '\n')
@@ -17,9 +17,10 @@ setup(
     license="MIT",
     zip_safe=False,
     platforms=["any"],
-    packages=['pyq', 'sizzle'],
+    packages=['pyq', 'pyq.bench', 'sizzle'],
     entry_points={
-        'console_scripts': ['pyq{} = pyq.pyq:main'.format(PYVERSION)],
+        'console_scripts': ['pyq{} = pyq.pyq:main'.format(PYVERSION),
+                            'pyq-bench = pyq.bench.suite:main'],
     },
     classifiers=[
         "Intended Audience :: Developers",
@@ -33,7 +34,5 @@ setup(
     install_requires=[
         'click==6.2',
         'Pygments==2.1',
-        'regex==2016.1.10',
-        'astor==0.5',
     ]
 )
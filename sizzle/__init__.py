@@ -0,0 +1,2 @@
+from .selector import (compile, Selector, SelectorGroup,  # noqa
+                       SelectorSyntaxError)
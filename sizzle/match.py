@@ -1,16 +1,52 @@
-from .selector import Selector
+from array import array
+
+from .selector import Selector, SelectorGroup
 
 
 class MatchEngine(object):
     pseudo_fns = {}
     selector_class = Selector
 
+    # the attribute operators implemented by match_attr, None for all the
+    # ones the selector syntax has
+    attr_operators = None
+
+    # pseudos checked after all the others
+    expensive_pseudos = ('has',)
+    max_predicates = 1024
+    max_rule_states = 256
+
+    # selectors with combinators are evaluated either top-down, matching the
+    # first compound selector and looking for the next ones in its body, or
+    # bottom-up, matching the last one and checking its ancestors; auto
+    # picks the cheapest according to estimate()
+    TOP_DOWN = 'top-down'
+    BOTTOM_UP = 'bottom-up'
+    AUTO = 'auto'
+    evaluation = AUTO
+
+    # average number of ancestors of a node, fraction of the nodes at the
+    # top level and the cost of building the tree of parents relative to a
+    # walk of the data
+    average_depth = 2.0
+    top_level = 0.1
+    tree_cost = 1.0
+
     def __init__(self):
+        self._predicates = {}
+        self._rule_states = {}
+        self._has_memo = {}
+        self._tree = None
+        self._pseudo_names = frozenset()
         self.register_pseudo('not', self.pseudo_not)
         self.register_pseudo('has', self.pseudo_has)
 
     def register_pseudo(self, name, fn):
         self.pseudo_fns[name] = fn
+        self._pseudo_names = frozenset(self.pseudo_fns)
+        self._predicates.clear()
+        self._rule_states.clear()
+        self._has_memo = {}
 
     @staticmethod
     def pseudo_not(matcher, node, value):
@@ -18,30 +54,211 @@ class MatchEngine(object):
 
     @staticmethod
     def pseudo_has(matcher, node, value):
+        selector = matcher.parse_selector(value)[0]
         for node, body in matcher.iter_data([node]):
             if body:
-                return any(
-                    matcher.match_data(matcher.parse_selector(value)[0], body))
+                return matcher.has_match(selector, node, body)
+
+    def has_match(self, selector, node, body):
+        # whether selector matches in the body of node, the same as
+        # any(self.match_data(selector, body)) but remembered for every node
+        # with a body walked along the way, so nested nodes checked later
+        # (eg. by def:has(call) on nested functions) are not walked again
+        #
+        # the memo keeps the nodes alive, so their ids are never reused, and
+        # is emptied by every new search
+        memo = self._has_memo
+        key = (id(node), selector)
+        try:
+            return memo[key][0]
+        except KeyError:
+            pass
+
+        predicate = self.predicate(selector)
+        next_selector = selector.next_selector
+        descend = selector.combinator != self.selector_class.CHILD
+
+        found = False
+        for child, child_body in self.iter_data(body):
+            if predicate(child):
+                if next_selector is None or child_body and \
+                        self.has_match(next_selector, child, child_body):
+                    found = True
+                    break
+
+            if child_body and descend and \
+                    self.has_match(selector, child, child_body):
+                found = True
+                break
+
+        memo[key] = (found, node)
+        return found
+
+    def compile(self, selector):
+        if isinstance(selector, SelectorGroup):
+            return selector
+        # unknown pseudos and operators are syntax errors
+        return self.selector_class.compile(selector, self._pseudo_names,
+                                           self.attr_operators)
 
     def parse_selector(self, selector):
-        return self.selector_class.parse(selector)
+        return self.compile(selector)
 
     def match(self, selector, data):
-        selectors = self.parse_selector(selector)
-        nodeids = {}
+        selectors = self.compile(selector)
+        self._has_memo = {}
+
+        # nodes found by a selector that is a single compound selector are
+        # the ones matching it, so they can be told apart by testing them
+        # again instead of remembering them
+        if all(self._simple(selector) for selector in selectors[:-1]):
+            found = [self._unique_matches(selector, data)
+                     for selector in selectors]
+            if None not in found:
+                tests = []
+                for selector, nodes in zip(selectors, found):
+                    for node in nodes:
+                        for test in tests:
+                            if test(node):
+                                break
+                        else:
+                            yield node
+                    tests.append(self.predicate(selector))
+                return
+
+        # otherwise selectors are evaluated over the numbered nodes of the
+        # tree, and the ones already found are marked in a bitset released
+        # with the search
+        tree = self.tree(data)
+        nodes = tree.nodes
+        seen = bytearray(len(nodes))
         for selector in selectors:
-            for node in self.match_data(selector, data):
-                nodeid = id(node)
-                if nodeid not in nodeids:
-                    nodeids[nodeid] = None
-                    yield node
+            if self.strategy(selector, data) == self.BOTTOM_UP:
+                indexes = self._bottom_up(selector, tree)
+            else:
+                indexes = self._top_down(selector, tree, 0, len(nodes))
+            for index in indexes:
+                if not seen[index]:
+                    seen[index] = 1
+                    yield nodes[index]
+
+    def _simple(self, selector):
+        return selector.next_selector is None and \
+            selector.combinator != self.selector_class.CHILD
+
+    def _unique_matches(self, selector, data):
+        # the nodes found by selector, None if some may be found more than
+        # once
+        if self.strategy(selector, data) == self.BOTTOM_UP:
+            return self.match_bottom_up(selector, data)
+        if not self.repeats(selector):
+            return self.match_data(selector, data)
+        return None
+
+    def repeats(self, selector):
+        # whether match_data can find a node more than once, through
+        # different ancestors
+        child = self.selector_class.CHILD
+        selector = selector.next_selector
+        while selector:
+            if selector.combinator != child:
+                return True
+            selector = selector.next_selector
+        return False
+
+    def compile_rules(self, rules):
+        # (rule id, selector) pairs, or a mapping of rule ids to selectors,
+        # as a RuleSet of compiled selector groups
+        if isinstance(rules, RuleSet):
+            return rules
+        if hasattr(rules, 'items'):
+            rules = rules.items()
+        return RuleSet((rule_id, self.compile(selector))
+                       for rule_id, selector in rules)
+
+    def match_many(self, rules, data):
+        # (rule id, node) for the nodes matched by each rule, evaluating all
+        # the rules in a single traversal of data; nodes are yielded in the
+        # order they are found, once per rule
+        rules = self.compile_rules(rules)
+        self._has_memo = {}
+
+        # the states of a body never hold the same selector twice, so only
+        # rules with several selectors can match a node more than once
+        groups = [len(group) > 1 for rule_id, group in rules]
+        seen = set()
+        for index, node in self._match_states(self._states(rules), data):
+            if groups[index]:
+                key = (index, id(node))
+                if key in seen:
+                    continue
+                seen.add(key)
+            yield rules[index][0], node
+
+    def _states(self, rules):
+        return self.rule_states(tuple(
+            (index, selector)
+            for index, (rule_id, group) in enumerate(rules)
+            for selector in group))
+
+    def rule_states(self, states):
+        try:
+            return self._rule_states[states]
+        except KeyError:
+            pass
+
+        if len(self._rule_states) >= self.max_rule_states:
+            self._rule_states.clear()
+        rule_states = self._rule_states[states] = _RuleStates(self, states)
+        return rule_states
+
+    def _match_states(self, states, data):
+        # the same walk as match_data, for all the selectors of states at
+        # once; selectors whose node matched continue with their next
+        # selector in its body, next to the ones that descend
+        by_class = states.by_class
+
+        for node, body in self.iter_data(data):
+            try:
+                candidates = by_class[type(node)]
+            except KeyError:
+                candidates = states.candidates(type(node))
+
+            advanced = None
+            for index, selector, predicate in candidates:
+                if predicate(node):
+                    next_selector = selector.next_selector
+                    if next_selector is None:
+                        yield index, node
+                    elif body:
+                        if advanced is None:
+                            advanced = []
+                        advanced.append((index, next_selector))
+
+            if body:
+                children = states.children(advanced)
+                if children is not None:
+                    for match in self._match_states(children, body):
+                        yield match
+
+    def selector_types(self, selector):
+        # the classes of the nodes a selector can match, None if any
+        return None
 
     def match_data(self, selector, data):
-        for node, body in self._iter_data(data):
-            match = self.match_node(selector, node)
+        predicate = self.predicate(selector)
+        next_selector = selector.next_selector
+        descend = selector.combinator != self.selector_class.CHILD
 
-            if match:
-                next_selector = selector.next_selector
+        for tupl in self.iter_data(data):
+            try:
+                node, body = tupl
+            except (TypeError, ValueError):
+                raise Exception(
+                    'The iter_data method must yield pair tuples containing '
+                    'the node and its body (empty if not available)')
+
+            if predicate(node):
                 if next_selector:
                     if body:
                         for node in self.match_data(next_selector, body):
@@ -49,47 +266,265 @@ class MatchEngine(object):
                 else:
                     yield node
 
-            if body and not selector.combinator == self.selector_class.CHILD:
+            if body and descend:
                 for node in self.match_data(selector, body):
                     yield node
 
+    def match_bottom_up(self, selector, data):
+        # the same nodes as match_data, in the same order (but once), found
+        # by testing the last compound selector against the candidates of
+        # its types and the others against their ancestors
+        tree = self.tree(data)
+        nodes = tree.nodes
+        for index in self._bottom_up(selector, tree):
+            yield nodes[index]
+
+    def _bottom_up(self, selector, tree):
+        nodes = tree.nodes
+
+        chain = []
+        while selector:
+            chain.append(selector)
+            selector = selector.next_selector
+
+        predicate = self.predicate(chain[-1])
+        types = self.selector_types(chain[-1])
+        if types is None:
+            candidates = range(len(nodes))
+        else:
+            candidates = tree.candidates(types)
+
+        # the other predicates, with their results per ancestor
+        tested = [(self.predicate(selector), {}) for selector in chain[:-1]]
+
+        # match_data finds nodes through their outermost ancestors first,
+        # paths are sorted as numbers with a digit per node
+        size = len(nodes)
+        found = []
+        for index in candidates:
+            if predicate(nodes[index]):
+                path = self._ancestor_path(chain, tested, tree, index)
+                if path is not None:
+                    key = 0
+                    for node_index in path:
+                        key = key * size + node_index
+                    found.append(key)
+
+        found.sort()
+        for key in found:
+            yield key % size
+
+    def _top_down(self, selector, tree, start, stop):
+        # match_data over the indexes of the tree, for the nodes from start
+        # to stop which are in the same body
+        nodes = tree.nodes
+        ends = tree.ends
+        predicate = self.predicate(selector)
+        next_selector = selector.next_selector
+        descend = selector.combinator != self.selector_class.CHILD
+
+        index = start
+        while index < stop:
+            end = ends[index]
+            if predicate(nodes[index]):
+                if next_selector:
+                    if end > index + 1:
+                        for found in self._top_down(next_selector, tree,
+                                                    index + 1, end):
+                            yield found
+                else:
+                    yield index
+
+            if descend and end > index + 1:
+                for found in self._top_down(selector, tree, index + 1, end):
+                    yield found
+            index = end
+
+    def _ancestor_path(self, chain, tested, tree, index):
+        # the indexes of the ancestors matching chain[:-1] followed by index,
+        # the outermost ones when several would, None if there are none
+        nodes = tree.nodes
+        parents = tree.parents
+        child = self.selector_class.CHILD
+
+        ancestors = []
+        parent = parents[index]
+        while parent != -1:
+            ancestors.append(parent)
+            parent = parents[parent]
+        ancestors.reverse()
+
+        last = len(chain) - 1
+        depth = len(ancestors)
+        if last > depth:
+            return None
+
+        # valid[i][j]: chain[i] matches ancestors[j] and the rest of the
+        # chain can be matched below it, up to index
+        valid = [None] * last
+        below = None
+        for i in range(last - 1, -1, -1):
+            is_child = chain[i + 1].combinator == child
+            predicate, results = tested[i]
+            row = [False] * depth
+            # whether a position after j is valid for the next selector
+            after = False
+            for j in range(depth - 1, -1, -1):
+                if below is None:
+                    ok = not is_child or j == depth - 1
+                elif is_child:
+                    ok = j + 1 < depth and below[j + 1]
+                else:
+                    ok = after
+                    after = after or below[j]
+                if ok:
+                    ancestor = ancestors[j]
+                    try:
+                        ok = results[ancestor]
+                    except KeyError:
+                        ok = results[ancestor] = predicate(nodes[ancestor])
+                row[j] = ok
+            valid[i] = below = row
+
+        path = []
+        start = 0
+        for i in range(last):
+            if i == 0:
+                positions = [0] if chain[0].combinator == child \
+                    else range(depth)
+            elif chain[i].combinator == child:
+                positions = [start]
+            else:
+                positions = range(start, depth)
+
+            for j in positions:
+                if j < depth and valid[i][j]:
+                    break
+            else:
+                return None
+
+            path.append(ancestors[j])
+            start = j + 1
+
+        path.append(index)
+        return tuple(path)
+
+    def strategy(self, selector, data=None):
+        # TOP_DOWN or BOTTOM_UP, by comparing the estimated number of
+        # predicate tests per node of the tree
+        if selector.next_selector is None:
+            return self.TOP_DOWN
+        if self.evaluation != self.AUTO:
+            return self.evaluation
+
+        chain = []
+        while selector:
+            chain.append(selector)
+            selector = selector.next_selector
+
+        # walking all the nodes (or the top level ones), and the bodies of
+        # those matching each selector but the last
+        top_down = 1.0
+        if chain[0].combinator == self.selector_class.CHILD:
+            top_down = self.top_level
+        for selector, next_selector in zip(chain, chain[1:]):
+            frequency, children, descendants = self.estimate(selector)
+            if next_selector.combinator == self.selector_class.CHILD:
+                top_down += frequency * children
+            else:
+                top_down += frequency * descendants
+
+        # the candidates of the last selector, and the ancestors of those
+        # matching it
+        last = chain[-1]
+        frequency = self.estimate(last)[0]
+        candidates = self.type_estimate(last.typ)[0] \
+            if self.selector_types(last) is not None else 1.0
+        bottom_up = candidates + \
+            frequency * (len(chain) - 1) * self.average_depth
+        if self._tree is None or self._tree.data is not data:
+            bottom_up += self.tree_cost
+
+        if bottom_up < top_down:
+            return self.BOTTOM_UP
+        return self.TOP_DOWN
+
+    def estimate(self, selector):
+        # the fraction of the nodes a compound selector matches, and the
+        # average number of nodes in the body of those (directly and in all)
+        frequency, children, descendants = self.type_estimate(selector.typ)
+        if selector.id_:
+            frequency *= 0.05
+        for lft, op, rgt in selector.attrs:
+            frequency *= 0.1 if op == '=' else 0.5
+        for pseudo in selector.pseudos:
+            frequency *= 0.5
+        return frequency, children, descendants
+
+    def type_estimate(self, typ):
+        # (fraction of the nodes, children, descendants) of a type
+        if typ:
+            return 0.2, 2.0, 10.0
+        return 1.0, 1.0, self.average_depth
+
+    def tree(self, data):
+        # the tree of parents of the last data matched bottom-up
+        tree = self._tree
+        if tree is None or tree.data is not data:
+            tree = self._tree = _Tree(self.iter_data, data)
+        return tree
+
     def match_node(self, selector, node):
-        match = all(self.match_rules(selector, node))
+        return self.predicate(selector)(node)
 
-        if match and selector.attrs:
-            match &= all(self.match_attrs(selector, node))
+    def predicate(self, selector):
+        try:
+            return self._predicates[selector]
+        except KeyError:
+            pass
 
-        if match and selector.pseudos:
-            match &= all(self.match_pseudos(selector, node))
+        if len(self._predicates) >= self.max_predicates:
+            self._predicates.clear()
+        predicate = self._predicates[selector] = \
+            self.compile_selector(selector)
+        return predicate
 
-        return match
+    def compile_selector(self, selector):
+        # a single function checking the type, id, attributes and pseudos of
+        # a selector in this order, with expensive pseudos (eg.: :has) last
+        tests = []
 
-    def match_rules(self, selector, node):
         if selector.typ:
-            yield self.match_type(selector.typ, node)
+            tests.append(self.compile_type(selector.typ))
 
         if selector.id_:
-            yield self.match_id(selector.id_, node)
+            tests.append(self.compile_id(selector.id_))
 
-    def match_attrs(self, selector, node):
-        for a in selector.attrs:
-            lft, op, rgt = a
-            yield self.match_attr(lft, op, rgt, node)
+        for lft, op, rgt in selector.attrs:
+            tests.append(self.compile_attr(lft, op, rgt))
 
-    def match_pseudos(self, selector, d):
-        for p in selector.pseudos:
-            name, value = p
-            if name not in self.pseudo_fns:
-                raise Exception('Selector not implemented: {}'.format(name))
-            yield self.pseudo_fns[name](self, d, value)
+        pseudos = sorted(selector.pseudos,
+                         key=lambda p: p.name in self.expensive_pseudos)
+        for name, value in pseudos:
+            tests.append(self.compile_pseudo(name, value))
 
-    def _iter_data(self, data):
-        for tupl in self.iter_data(data):
-            if len(tupl) != 2:
-                raise Exception(
-                    'The iter_data method must yield pair tuples containing '
-                    'the node and its body (empty if not available)')
-            yield tupl
+        return _all(tests)
+
+    def compile_type(self, typ):
+        return lambda node: self.match_type(typ, node)
+
+    def compile_id(self, id_):
+        return lambda node: self.match_id(id_, node)
+
+    def compile_attr(self, lft, op, rgt):
+        return lambda node: self.match_attr(lft, op, rgt, node)
+
+    def compile_pseudo(self, name, value):
+        try:
+            fn = self.pseudo_fns[name]
+        except KeyError:
+            raise Exception('Selector not implemented: {}'.format(name))
+        return lambda node: fn(self, node, value)
 
     def match_type(self, typ, node):
         raise NotImplementedError
@@ -102,3 +537,118 @@ class MatchEngine(object):
 
     def iter_data(self, data):
         raise NotImplementedError
+
+
+class _Tree(object):
+    # the nodes of data in the order match_data finds them, with the index
+    # of the node holding each in its body (-1 at the top level), the index
+    # after the last node of its body and the indexes of the nodes of each
+    # class; indexes are kept in arrays, which take less memory than lists
+    # on large modules
+    def __init__(self, iter_data, data):
+        self.data = data
+        self.nodes = nodes = []
+        self.parents = parents = array('i')
+        self.ends = ends = array('i')
+        self.by_class = by_class = {}
+
+        stack = [(iter(iter_data(data)), -1)]
+        while stack:
+            items, parent = stack[-1]
+            for node, body in items:
+                index = len(nodes)
+                nodes.append(node)
+                parents.append(parent)
+                ends.append(index + 1)
+                try:
+                    by_class[type(node)].append(index)
+                except KeyError:
+                    by_class[type(node)] = array('i', (index,))
+                if body:
+                    stack.append((iter(iter_data(body)), index))
+                    break
+            else:
+                stack.pop()
+                if parent != -1:
+                    ends[parent] = len(nodes)
+
+    def candidates(self, types):
+        # indexes of the nodes of the given classes, in order
+        lists = [self.by_class[cls] for cls in types if cls in self.by_class]
+        if len(lists) == 1:
+            return lists[0]
+        return sorted(index for indexes in lists for index in indexes)
+
+
+class RuleSet(tuple):
+    # the (rule id, SelectorGroup) pairs of MatchEngine.compile_rules
+    pass
+
+
+class _RuleStates(object):
+    # (rule index, selector) pairs being tested against the nodes of a
+    # level, with the candidates for each node class and the states of the
+    # levels below memoized
+    def __init__(self, engine, states):
+        self.engine = engine
+        self.states = states
+        self.by_class = {}
+        self._children = {}
+
+        child = engine.selector_class.CHILD
+        self.descend = tuple(state for state in states
+                             if state[1].combinator != child)
+        self.tests = tuple(
+            (index, selector, engine.predicate(selector),
+             engine.selector_types(selector))
+            for index, selector in states)
+
+    def candidates(self, cls):
+        candidates = self.by_class[cls] = tuple(
+            (index, selector, predicate)
+            for index, selector, predicate, types in self.tests
+            if types is None or cls in types)
+        return candidates
+
+    def children(self, advanced):
+        # the states of a body, None if nothing can match in it
+        key = tuple(advanced) if advanced else ()
+        try:
+            return self._children[key]
+        except KeyError:
+            pass
+
+        # kept in the order of the rules, so a node matched by several of
+        # them is yielded for each in that order
+        states = list(self.descend)
+        for state in key:
+            if state not in states:
+                states.append(state)
+        states.sort(key=lambda state: state[0])
+
+        children = self._children[key] = \
+            self.engine.rule_states(tuple(states)) if states else None
+        return children
+
+
+def _all(tests):
+    # a predicate true when all tests are, without any generator involved
+    if not tests:
+        return lambda node: True
+
+    if len(tests) == 1:
+        return tests[0]
+
+    if len(tests) == 2:
+        first, second = tests
+        return lambda node: first(node) and second(node)
+
+    tests = tuple(tests)
+
+    def predicate(node):
+        for test in tests:
+            if not test(node):
+                return False
+        return True
+
+    return predicate
@@ -1,4 +1,4 @@
-import regex
+import re
 
 from collections import namedtuple
 
@@ -7,6 +7,37 @@ Attr = namedtuple('Attr', 'lft op rgt')
 Pseudo = namedtuple('Pseudo', 'name value')
 
 
+# compiled selector groups, keyed by selector class and selector string
+_compiled = {}
+_compiled_max_size = 1024
+
+
+def compile(selector):
+    return Selector.compile(selector)
+
+
+class SelectorSyntaxError(ValueError):
+    # raised for invalid selectors, position is the offset in selector of
+    # the character that could not be parsed
+    def __init__(self, message, selector, position):
+        super(SelectorSyntaxError, self).__init__(
+            '{} at position {} of {!r}'.format(message, position, selector))
+        self.message = message
+        self.selector = selector
+        self.position = position
+
+
+class SelectorGroup(tuple):
+    # the comma-separated selectors of a compiled selector string
+    def __new__(cls, source, selectors):
+        group = super(SelectorGroup, cls).__new__(cls, selectors)
+        group.source = source
+        return group
+
+    def __repr__(self):
+        return 'SelectorGroup <{}>'.format(self.source)
+
+
 class Selector(object):
     DESCENDANT = ' '
     CHILD = '>'
@@ -14,110 +45,258 @@ class Selector(object):
     ADJACENT = '+'
     NOT_SET = None
 
-    class RE(object):
-        id = r'_?[A-Za-z0-9_]+|_'
-        ws = r'[\x20\t\r\n\f]*'
-        comma = '^{ws},{ws}'.format(ws=ws)
-        combinator = r'^{ws}([>+~ ]){ws}'.format(ws=ws)
-
-        type_selector = '({id})'.format(id=id)
-        id_selector = '#({id})'.format(id=id)
-        class_selector = r'\.(' + id + ')'
-        pseudo_selector = r'(:({id})\(([^()]+|(?1)?)\))'.format(id=id)
-        attr_selector = r'\[{ws}({id}){ws}([*^$|!~]?=)(.*?)\]'.format(
-            id=id, ws=ws)
-
-        selector = '(?:(?:{typ})?({id}|{cls}|{pseudo}|{attr})+|{typ})'.format(
-            typ=id, id=id_selector, cls=class_selector, pseudo=pseudo_selector,
-            attr=attr_selector)
+    # pseudos taking a selector, their arguments are compiled along with
+    # the selector so errors are raised with the others; True for the ones
+    # that can be left empty
+    selector_pseudos = {'not': False, 'has': False}
 
     def __init__(self, name, combinator=None):
+        # a single compound selector, eg. Selector('class#Foo:has(def)')
+        parser = _Parser(name, type(self))
+        parts, pos = parser.compound(0)
+        if pos != len(name):
+            parser.unexpected(pos)
+        self._set(name, combinator, *parts)
+
+    def _set(self, name, combinator, typ, id_, classes, attrs, pseudos):
         self.name = name
         self.combinator = combinator
         self.next_selector = None
+        self.typ = typ
+        self.id_ = id_
+        self.classes = classes
+        self.attrs = attrs
+        self.pseudos = pseudos
 
-        selector_patterns = {
-            'types': self.RE.type_selector,
-            'ids': self.RE.id_selector,
-            'classes': self.RE.class_selector,
-            'pseudos': self.RE.pseudo_selector,
-            'attrs': self.RE.attr_selector,
-        }
+    def __repr__(self):
+        return 'Selector <{}>'.format(self.name)
 
-        matches = {}
+    @classmethod
+    def compile(cls, string, pseudos=None, operators=None):
+        # pseudos and operators are the names of the pseudos and attribute
+        # operators that can be matched, None for any
+        key = (cls, string, pseudos, operators)
+        try:
+            return _compiled[key]
+        except KeyError:
+            pass
 
-        while True:
-            pattern_matched = False
-            for key, pattern in selector_patterns.items():
-                match = regex.search(r'^{}'.format(pattern), name)
-                if match:
-                    i, pos = match.span()
-                    if key not in matches:
-                        matches[key] = []
-                    matches[key].append(match.groups())
-                    name = name[pos:]
-                    pattern_matched = True
-            if not pattern_matched:
-                break
+        # the arguments of selector_pseudos are compiled along, so matching
+        # never has to parse
+        parser = _Parser(string, cls, True, pseudos, operators)
+        group = SelectorGroup(string, parser.group())
 
-        self.typ = None
-        for types in matches.pop('types', []):
-            self.typ = types[0]
+        if len(_compiled) >= _compiled_max_size:
+            _compiled.clear()
+        _compiled[key] = group
+        return group
 
-        self.id_ = None
-        for ids in matches.pop('ids', []):
-            self.id_ = ids[0]
+    @classmethod
+    def parse(cls, string):
+        return _Parser(string, cls).group()
 
-        self.classes = [a[0] for a in matches.pop('classes', [])]
 
-        self.attrs = [
-            Attr(l, o, r.strip())
-            for l, o, r in matches.pop('attrs', [])
-        ]
-        self.pseudos = [
-            Pseudo(*a[1:])
-            for a in matches.pop('pseudos', [])
-        ]
+_WS = re.compile(r'[ \t\r\n\f]*')
+_NAME = re.compile(r'\w+', re.U)
+_ATTR_OP = re.compile(r'[*^$|!~]?=')
+_PARENS = re.compile(r'[()\[]')
 
-    def __repr__(self):
-        return 'Selector <{}>'.format(self.name)
+_COMBINATORS = frozenset('>+~')
 
-    @classmethod
-    def parse(cls, string):
+
+class _Parser(object):
+    # a single pass over a selector string:
+    #
+    #   group      := complex (',' complex)*
+    #   complex    := combinator? compound (combinator? compound)*
+    #   compound   := name? ('#' name | '.' name | attr | pseudo)*
+    #   attr       := '[' name op value ']'
+    #   pseudo     := ':' name '(' balanced parentheses ')'
+    #
+    # with optional whitespace around combinators and commas, whitespace
+    # alone between two compounds being the descendant combinator
+    def __init__(self, string, cls=Selector, arguments=False, pseudos=None,
+                 operators=None):
+        # arguments tells whether to compile the arguments of selector
+        # pseudos, pseudos and operators are the ones known (None for any)
+        self.string = string
+        self.cls = cls
+        self.arguments = arguments
+        self.pseudos = pseudos
+        self.operators = operators
+
+    def error(self, message, pos):
+        raise SelectorSyntaxError(message, self.string, pos)
+
+    def unexpected(self, pos):
+        self.error('Unexpected {!r}'.format(self.string[pos]), pos)
+
+    def skip(self, pos):
+        return _WS.match(self.string, pos).end()
+
+    def group(self):
+        cls = self.cls
+        string = self.string
+        end = len(string)
         selectors = []
 
+        pos = self.skip(0)
+        if pos == end:
+            return selectors
+
+        while True:
+            selector, pos = self.complex(cls, pos)
+            selectors.append(selector)
+            if pos == end:
+                return selectors
+            # complex only stops at the end or before a comma
+            pos = self.skip(pos + 1)
+
+    def complex(self, cls, pos):
+        string = self.string
+        end = len(string)
+
         combinator = None
-        prev_selector = None
+        if pos < end and string[pos] in _COMBINATORS:
+            combinator = string[pos]
+            pos = self.skip(pos + 1)
 
+        first = prev = None
         while True:
-            match = regex.search(cls.RE.comma, string)
-            if match:
-                # skip comma
-                _, pos = match.span()
-                string = string[pos:]
-                continue
-
-            match = regex.search(cls.RE.combinator, string)
-            if match:
-                _, pos = match.span()
-                combinator = string[:pos].strip()
-                string = string[pos:]
+            start = pos
+            parts, pos = self.compound(pos)
+            if pos == start:
+                if pos == end:
+                    self.error('Expected selector', pos)
+                self.unexpected(pos)
+
+            selector = cls.__new__(cls)
+            selector._set(string[start:pos], combinator, *parts)
+            if prev is None:
+                first = selector
+            else:
+                prev.next_selector = selector
+            prev = selector
+
+            after = self.skip(pos)
+            if after == end or string[after] == ',':
+                return first, after
+
+            if string[after] in _COMBINATORS:
+                combinator = string[after]
+                pos = self.skip(after + 1)
+            elif after > pos:
+                combinator = Selector.DESCENDANT
+                pos = after
             else:
-                combinator = None
-
-            match = regex.search(cls.RE.selector, string)
-            if match:
-                _, pos = match.span()
-                seltext = string[:pos]
-                string = string[pos:]
-                selector = cls(seltext, combinator=combinator)
-                if combinator is not None and prev_selector:
-                    prev_selector.next_selector = prev_selector = selector
-                else:
-                    prev_selector = selector
-                    selectors.append(selector)
-                continue
-
-            break
-
-        return selectors
+                self.unexpected(pos)
+
+    def compound(self, pos):
+        # (typ, id_, classes, attrs, pseudos) of the compound selector at
+        # pos, and the position after it
+        string = self.string
+        end = len(string)
+
+        typ = None
+        id_ = None
+        classes = []
+        attrs = []
+        pseudos = []
+
+        match = _NAME.match(string, pos)
+        if match:
+            typ = match.group()
+            pos = match.end()
+
+        while pos < end:
+            c = string[pos]
+            if c == '#':
+                id_, pos = self.name(pos + 1, "'#'")
+            elif c == '.':
+                name, pos = self.name(pos + 1, "'.'")
+                classes.append(name)
+            elif c == '[':
+                attr, pos = self.attr(pos)
+                attrs.append(attr)
+            elif c == ':':
+                pseudo, pos = self.pseudo(pos)
+                pseudos.append(pseudo)
+            else:
+                break
+
+        return (typ, id_, classes, attrs, pseudos), pos
+
+    def name(self, pos, after):
+        match = _NAME.match(self.string, pos)
+        if not match:
+            self.error('Expected name after {}'.format(after), pos)
+        return match.group(), match.end()
+
+    def attr(self, start):
+        string = self.string
+
+        lft, pos = self.name(self.skip(start + 1), "'['")
+
+        pos = self.skip(pos)
+        match = _ATTR_OP.match(string, pos)
+        if not match:
+            self.error('Expected attribute operator', pos)
+        op = match.group()
+        if self.operators is not None and op not in self.operators:
+            self.error('Unknown attribute operator {!r}'.format(op), pos)
+
+        close = string.find(']', match.end())
+        if close == -1:
+            self.error('Unterminated attribute selector', start)
+
+        return Attr(lft, op, string[match.end():close].strip()), close + 1
+
+    def pseudo(self, start):
+        string = self.string
+
+        name, pos = self.name(start + 1, "':'")
+        if self.pseudos is not None and name not in self.pseudos:
+            self.error("Unknown pseudo ':{}()'".format(name), start + 1)
+        if string[pos:pos + 1] != '(':
+            self.error("Expected '(' after ':{}'".format(name), pos)
+
+        # the argument is kept as written, up to the matching parenthesis
+        # (brackets of attribute selectors may hold any character)
+        depth = 1
+        value_start = pos = pos + 1
+        while True:
+            match = _PARENS.search(string, pos)
+            if match is None:
+                self.error('Unbalanced parenthesis', value_start - 1)
+            pos = match.end()
+            c = match.group()
+            if c == '[':
+                close = string.find(']', pos)
+                if close == -1:
+                    self.error('Unterminated attribute selector',
+                               match.start())
+                pos = close + 1
+            elif c == '(':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    value = string[value_start:pos - 1]
+                    if self.arguments:
+                        self.selector_argument(name, value, value_start)
+                    return Pseudo(name, value), pos
+
+    def selector_argument(self, name, value, start):
+        # compiles the argument of the pseudos taking a selector, with
+        # errors positioned in the whole string
+        cls = self.cls
+        if name not in cls.selector_pseudos:
+            return
+
+        try:
+            group = cls.compile(value, self.pseudos, self.operators)
+        except SelectorSyntaxError as e:
+            self.error(e.message, start + e.position)
+
+        if not group and not cls.selector_pseudos[name]:
+            self.error("Expected selector in ':{}()'".format(name), start)
@@ -1,8 +1,14 @@
+import json
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
 from click.testing import CliRunner
-from pyq.pyq import main
+from pyq.files import IgnoreFile, find_git_dir, read_git_index
+from pyq.pyq import main, prefetch, SourceLines
 
 
 def pjoin(*path):
@@ -30,17 +36,101 @@ class TestASTMatchEngine(unittest.TestCase):
         self.assertNotEqual(result.exit_code, 0)
         self.assertIn('Missing argument "selector"', result.output_bytes)
 
+    def test_syntax_error(self):
+        result = self.invoke(main, ['class > def!'])
+
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn("Unexpected '!'\n\n  class > def!\n             ^",
+                      result.output_bytes)
+
+    def test_syntax_error_in_pseudo(self):
+        for selector, caret in (('def:has()', '          ^'),
+                                ('def:not(!)', '          ^'),
+                                ('class:extends(!)', '                ^'),
+                                ('def:foo()', '      ^'),
+                                ('def:not(:foo())', '           ^'),
+                                ('def[name~=x]', '          ^')):
+            result = self.invoke(main, [selector])
+
+            self.assertEqual(result.exit_code, 2, selector)
+            self.assertIn('\n\n  {}\n{}'.format(selector, caret),
+                          result.output)
+
+        result = self.invoke(main, ['class:extends()'])
+        self.assertEqual(result.exit_code, 0)
+
     def test_nodir(self):
         result = self.invoke(main, ['def'])
         output = result.output_bytes.splitlines()
 
         self.assertEqual(result.exit_code, 0)
-        self.assertEqual(len(output), 4)
+        self.assertEqual(len(output), 3)
         self.assertEqual(output[0], 'cmd.py:7  def foo(self):')
         self.assertEqual(output[1], 'cmd.py:11  def baz(arg1, arg2):')
         self.assertEqual(output[2], 'file2.py:1  def hello():')
+
+    def test_hidden(self):
+        result = self.invoke(main, ['--hidden', 'def'])
+        output = result.output_bytes.splitlines()
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(len(output), 4)
         self.assertEqual(output[3], '.test_hidden_dir/foo.py:1  def bar():')
 
+        result = self.invoke(main, ['def', '.test_hidden_dir'])
+        output = result.output_bytes.splitlines()
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(output, ['.test_hidden_dir/foo.py:1  def bar():'])
+
+    def test_ignore_files(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for fn in ('a.py', 'b.py', 'build/c.py', 'pkg/d.py',
+                       'pkg/e.py', 'pkg/sub/f.py', 'venv/lib/g.py'):
+                path = os.path.join(tmpdir, fn)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'w') as fp:
+                    fp.write('def foo():\n    pass\n')
+
+            with open(os.path.join(tmpdir, '.gitignore'), 'w') as fp:
+                fp.write('# build output\nbuild/\nb.py\n/venv\n')
+            with open(os.path.join(tmpdir, 'pkg', '.pyqignore'), 'w') as fp:
+                fp.write('*.py\n!d.py\n')
+
+            r = self.invoke(main, ['-l', 'def', tmpdir])
+            self.assertEqual(r.exit_code, 0)
+            self.assertEqual(
+                [os.path.relpath(fn, tmpdir) for fn in r.output.split()],
+                ['a.py', os.path.join('pkg', 'd.py')])
+
+            r = self.invoke(main, ['-l', '--no-ignore', 'def', tmpdir])
+            self.assertEqual(len(r.output.split()), 7)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parse_errors(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for fn, source in (('a.py', b'def foo(:\n'),
+                               ('b.py', b'def bar():\n    "\xe9"\n'),
+                               ('c.py', b'def baz():\n    pass\n')):
+                with open(os.path.join(tmpdir, fn), 'wb') as fp:
+                    fp.write(source)
+
+            result = self.invoke(main, ['def', tmpdir])
+        finally:
+            shutil.rmtree(tmpdir)
+
+        # invalid files are reported on stderr and the search goes on
+        self.assertEqual(result.exit_code, 0)
+        output = result.output.splitlines()
+        self.assertEqual(len(output), 3)
+        self.assertIn('a.py:1: ', output[0])
+        self.assertTrue(output[1].endswith('b.py:1  def bar():'))
+        self.assertTrue(output[2].endswith('c.py:1  def baz():'))
+
     def test_notpyfile(self):
         result = self.invoke(main, ['def', 'notpyfile.txt'])
 
@@ -121,6 +211,451 @@ class TestASTMatchEngine(unittest.TestCase):
         self.assertEqual(len(output3), 1)
         self.assertEqual(output3[0], 'cmd.py')
 
+    def test_jobs(self):
+        r1 = self.invoke(main, ['def'])
+        r2 = self.invoke(main, ['-j', '2', 'def'])
+        r3 = self.invoke(main, ['-j', '2', '--unordered', 'def'])
+
+        self.assertEqual(r2.exit_code, 0)
+        self.assertEqual(r2.output, r1.output)
+
+        self.assertEqual(r3.exit_code, 0)
+        self.assertEqual(sorted(r3.output.splitlines()),
+                         sorted(r1.output.splitlines()))
+
+    def test_max_count(self):
+        r1 = self.invoke(main, ['-m', '1', 'def'])
+        r2 = self.invoke(main, ['--max-total', '2', 'def'])
+        r3 = self.invoke(main, ['-m', '1', '-e', 'call', 'cmd.py'])
+        r4 = self.invoke(main, ['--max-total', '1', '--format', 'ndjson',
+                                'def'])
+
+        self.assertEqual(r1.exit_code, 0)
+        self.assertEqual(r1.output_bytes.splitlines(),
+                         ['cmd.py:7  def foo(self):',
+                          'file2.py:1  def hello():'])
+
+        self.assertEqual(r2.exit_code, 0)
+        self.assertEqual(r2.output_bytes.splitlines(),
+                         ['cmd.py:7  def foo(self):',
+                          'cmd.py:11  def baz(arg1, arg2):'])
+
+        self.assertEqual(r3.output_bytes.splitlines(),
+                         ['cmd.py:15:0  foo() | bar()'])
+
+        self.assertEqual([json.loads(line)['name']
+                          for line in r4.output.splitlines()], ['foo'])
+
+        for jobs in ('1', '2'):
+            r = self.invoke(main, ['-j', jobs, '-m', '1', 'def'])
+            self.assertEqual(r.output, r1.output)
+
+    def test_quiet(self):
+        for jobs in ('1', '2'):
+            r1 = self.invoke(main, ['-j', jobs, '-q', 'def'])
+            r2 = self.invoke(main, ['-j', jobs, '-q', 'def#nothing'])
+
+            self.assertEqual(r1.exit_code, 0)
+            self.assertEqual(r1.output, '')
+            self.assertEqual(r2.exit_code, 1)
+            self.assertEqual(r2.output, '')
+
+    def test_format(self):
+        r1 = self.invoke(main, ['--format', 'ndjson', 'def', 'cmd.py'])
+        r2 = self.invoke(main, ['--format', 'json', 'def', 'cmd.py'])
+        r3 = self.invoke(main, ['--format', 'tsv', 'def', 'cmd.py'])
+        r4 = self.invoke(main, ['--format', 'json', 'def#nothing'])
+
+        self.assertEqual(r1.exit_code, 0)
+        records = [json.loads(line) for line in r1.output.splitlines()]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0], {
+            'path': 'cmd.py', 'line': 7, 'col': 4, 'end_line': 8,
+            'end_col': 12, 'type': 'FunctionDef', 'name': 'foo'})
+        self.assertEqual(records[1]['name'], 'baz')
+
+        self.assertEqual(r2.exit_code, 0)
+        self.assertEqual(json.loads(r2.output), records)
+
+        self.assertEqual(r3.exit_code, 0)
+        self.assertEqual(r3.output.splitlines(), [
+            'cmd.py\t7\t4\t8\t12\tFunctionDef\tfoo',
+            'cmd.py\t11\t0\t12\t8\tFunctionDef\tbaz'])
+
+        self.assertEqual(r4.exit_code, 0)
+        self.assertEqual(json.loads(r4.output), [])
+
+        r = self.invoke(main, ['-j', '2', '--format', 'ndjson', 'def'])
+        self.assertEqual(r.output, self.invoke(
+            main, ['--format', 'ndjson', 'def']).output)
+
+        r = self.invoke(main, ['-l', '--format', 'json', 'def'])
+        self.assertNotEqual(r.exit_code, 0)
+
+    def test_color(self):
+        r1 = self.invoke(main, ['def', 'cmd.py'])
+        r2 = self.invoke(main, ['--color', 'always', 'def', 'cmd.py'])
+        r3 = self.invoke(main, ['--color', 'never', 'def', 'cmd.py'])
+
+        # not a terminal, so no color by default
+        self.assertEqual(r1.exit_code, 0)
+        self.assertNotIn('\x1b[', r1.output)
+
+        self.assertEqual(r2.exit_code, 0)
+        self.assertIn('\x1b[', r2.output)
+        self.assertEqual(len(r2.output.splitlines()), 2)
+
+        self.assertEqual(r3.output, r1.output)
+
+    def test_index(self):
+        tmpdir = tempfile.mkdtemp()
+        index_file = os.path.join(tmpdir, 'index')
+        try:
+            r = self.invoke(main, ['index', 'build', '-f', index_file])
+            self.assertEqual(r.exit_code, 0)
+
+            r1 = self.invoke(main, ['-e', 'class:extends(#object)'])
+            r2 = self.invoke(main, ['-e', '--index', index_file,
+                                    'class:extends(#object)'])
+            self.assertEqual(r2.exit_code, 0)
+            self.assertEqual(r2.output, r1.output)
+
+            r1 = self.invoke(main, ['--format', 'ndjson', 'class, def#foo'])
+            r2 = self.invoke(main, ['--format', 'ndjson', '--index',
+                                    index_file, 'class, def#foo'])
+            self.assertEqual(r2.exit_code, 0)
+            self.assertEqual(r2.output, r1.output)
+
+            r = self.invoke(main, ['index', 'update', '-f', index_file])
+            self.assertEqual(r.exit_code, 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_bench(self):
+        from pyq.bench import suite
+
+        result = self.invoke(suite.main, ['--files', '2', '--repeat', '1',
+                                          '--json'])
+        results = json.loads(result.output)
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(results['corpus']['files'], 2)
+        self.assertGreater(results['corpus']['nodes'], 0)
+        self.assertEqual([b['name'] for b in results['benchmarks']][:3],
+                         ['parse selectors', 'parse files', 'traverse'])
+        self.assertIn('match class > def',
+                      [b['name'] for b in results['benchmarks']])
+
+        fd, previous = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(result.output)
+            result = self.invoke(suite.main, ['--files', '2', '--repeat',
+                                              '1', '--compare', previous])
+        finally:
+            os.remove(previous)
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('speedup', result.output)
+
+    def test_stats(self):
+        result = self.invoke(main, ['-q', '--stats-json', 'def:has(call)'])
+        stats = json.loads(result.output)
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(stats['counters']['files walked'], 4)
+        self.assertEqual(stats['counters']['matches'], 1)
+        self.assertGreater(stats['counters']['nodes visited'], 0)
+        self.assertGreater(stats['pseudos']['has'], 0)
+        self.assertIn('parse', stats['phases'])
+        self.assertEqual(stats['slowest'][0]['path'], 'cmd.py')
+
+        result = self.invoke(main, ['--stats', 'def', 'cmd.py'])
+        self.assertIn('cmd.py:7  def foo(self):', result.output)
+        self.assertIn('files parsed', result.output)
+
+    def test_profile(self):
+        import pstats
+
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            result = self.invoke(main, ['--profile', filename, 'def'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertGreater(pstats.Stats(filename).total_calls, 0)
+        finally:
+            os.remove(filename)
+
+    def test_rules(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            yaml_file = os.path.join(tmpdir, 'rules.yaml')
+            with open(yaml_file, 'w') as fp:
+                fp.write('rules:\n'
+                         '  - id: methods\n'
+                         '    selector: class > def\n'
+                         '  - id: defs\n'
+                         '    selector: def\n')
+            json_file = os.path.join(tmpdir, 'rules.json')
+            with open(json_file, 'w') as fp:
+                json.dump({'methods': 'class > def', 'defs': 'def'}, fp)
+
+            r1 = self.invoke(main, ['--rules', json_file, 'cmd.py'])
+            self.assertEqual(r1.exit_code, 0)
+            self.assertEqual(r1.output.splitlines(), [
+                'cmd.py:7  [methods]  def foo(self):',
+                'cmd.py:7  [defs]  def foo(self):',
+                'cmd.py:11  [defs]  def baz(arg1, arg2):'])
+
+            try:
+                import yaml  # noqa
+            except ImportError:
+                pass
+            else:
+                r2 = self.invoke(main, ['--rules', yaml_file, 'cmd.py'])
+                self.assertEqual(r2.output, r1.output)
+
+            r = self.invoke(main, ['--rules', json_file, '--format', 'ndjson',
+                                   'cmd.py'])
+            self.assertEqual([(record['rule'], record['name']) for record in
+                              map(json.loads, r.output.splitlines())],
+                             [('methods', 'foo'), ('defs', 'foo'),
+                              ('defs', 'baz')])
+
+            r1 = self.invoke(main, ['--rules', json_file, '--format', 'tsv'])
+            r2 = self.invoke(main, ['--rules', json_file, '--format', 'tsv',
+                                    '-j', '2'])
+            self.assertEqual(r1.exit_code, 0)
+            self.assertEqual(r2.output, r1.output)
+
+            # -l is given (rule, match, lineno) of the first match
+            for args in (['-m', '1'], ['--max-total', '1'], ['-j', '2'],
+                         ['-j', '2', '-m', '1']):
+                r = self.invoke(main, ['--rules', json_file, '-l'] + args)
+                self.assertEqual(r.exit_code, 0, args)
+                self.assertEqual(r.output.splitlines()[0], 'cmd.py', args)
+
+            r = self.invoke(main, ['--rules', json_file, '-l', '--max-total',
+                                   '1'])
+            self.assertEqual(r.output, 'cmd.py\n')
+
+            with open(json_file, 'w') as fp:
+                json.dump([{'id': 'bad', 'selector': 'def!'}], fp)
+            r = self.invoke(main, ['--rules', json_file])
+            self.assertEqual(r.exit_code, 2)
+            self.assertIn("rule bad: Unexpected '!'", r.output)
+
+            with open(json_file, 'w') as fp:
+                json.dump([{'id': 'defs'}], fp)
+            r = self.invoke(main, ['--rules', json_file])
+            self.assertEqual(r.exit_code, 2)
+            self.assertIn('rule 1 has no selector', r.output)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_prefetch(self):
+        r1 = self.invoke(main, ['--prefetch', '0', 'def'])
+        r2 = self.invoke(main, ['--prefetch', '2', 'def'])
+
+        self.assertEqual(r1.exit_code, 0)
+        self.assertEqual(r2.exit_code, 0)
+        self.assertEqual(r2.output, r1.output)
+
+        filenames = ['cmd.py', 'nofile.py', 'file2.py']
+        results = list(prefetch(filenames, 1))
+        self.assertEqual([fn for fn, source in results], filenames)
+        self.assertTrue(results[0][1].startswith(b'class Foo'))
+        self.assertIsNone(results[1][1])
+
+        # files are read once for parsing and lines even without threads
+        self.assertEqual(list(prefetch(filenames, 0)), results)
+        self.assertEqual(list(prefetch(filenames[:1], 2)), results[:1])
+
+
+class TestStartup(unittest.TestCase):
+    # modules imported only by the options that need them
+    LAZY_MODULES = ('astor', 'multiprocessing', 'pygments', 'pyq.cache',
+                    'pyq.server', 'sqlite3', 'subprocess')
+
+    # seconds, for `import pyq.pyq` as measured by python -X importtime
+    IMPORT_BUDGET = 0.5
+
+    def python(self, *args):
+        proc = subprocess.Popen(
+            (sys.executable,) + args, cwd=pjoin('testfiles', 'cmd'),
+            env=dict(os.environ, PYTHONPATH=pjoin()),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        self.assertEqual(proc.returncode, 0, err)
+        return out.decode('utf-8'), err.decode('utf-8')
+
+    def test_lazy_imports(self):
+        out, err = self.python('-c', (
+            'import sys\n'
+            'from pyq.pyq import main\n'
+            'try:\n'
+            '    main(["-l", "def", "cmd.py", "file2.py"])\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            'print(" ".join(m for m in {!r} if m in sys.modules))\n'
+        ).format(self.LAZY_MODULES))
+
+        self.assertEqual(out.splitlines(), ['cmd.py', 'file2.py', ''])
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'no -X importtime')
+    def test_import_time(self):
+        out, err = self.python('-X', 'importtime', '-c', 'import pyq.pyq')
+
+        for line in err.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == 'pyq.pyq':
+                cumulative = int(fields[1]) / 1e6
+                break
+        else:
+            self.fail('pyq.pyq not found in:\n' + err)
+
+        self.assertLess(cumulative, self.IMPORT_BUDGET)
+
+
+def git(*args):
+    subprocess.check_call(
+        ('git', '-c', 'user.name=pyq', '-c', 'user.email=pyq@example.com')
+        + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+try:
+    git('--version')
+except OSError:
+    HAS_GIT = False
+else:
+    HAS_GIT = True
+
+
+@unittest.skipUnless(HAS_GIT, 'git is not installed')
+class TestGitFiles(unittest.TestCase):
+    def setUp(self):
+        self.runner = CliRunner()
+        self.currentdir = os.getcwd()
+        self.tmpdir = os.path.realpath(tempfile.mkdtemp())
+        os.chdir(self.tmpdir)
+
+        for fn in ('a.py', 'b.py', 'pkg/c.py', 'pkg/d.txt', '.hidden/e.py'):
+            self.write(fn)
+        git('init', '-q')
+        git('add', '.')
+        git('commit', '-q', '-m', 'initial')
+
+    def tearDown(self):
+        os.chdir(self.currentdir)
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, fn, source='def foo():\n    pass\n'):
+        if os.path.dirname(fn) and not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        with open(fn, 'w') as fp:
+            fp.write(source)
+
+    def files(self, *args):
+        r = self.runner.invoke(main, ('-l', 'def') + args,
+                               catch_exceptions=False)
+        self.assertEqual(r.exit_code, 0, r.output)
+        return r.output.split()
+
+    def test_git(self):
+        self.write('untracked.py')
+
+        self.assertEqual(self.files('--git'),
+                         ['a.py', 'b.py', os.path.join('pkg', 'c.py')])
+        self.assertEqual(self.files('--git', '--hidden'),
+                         [os.path.join('.hidden', 'e.py'), 'a.py', 'b.py',
+                          os.path.join('pkg', 'c.py')])
+        self.assertEqual(self.files('--git', 'pkg'),
+                         [os.path.join('pkg', 'c.py')])
+
+        os.chdir('pkg')
+        self.assertEqual(self.files('--git', '..'),
+                         [os.path.join('..', 'a.py'),
+                          os.path.join('..', 'b.py'), 'c.py'])
+
+    def test_changed_since(self):
+        self.assertEqual(self.files('--changed-since', 'HEAD'), [])
+
+        self.write('b.py', 'def bar():\n    pass\n')
+        self.write('pkg/new.py')
+        os.remove('a.py')
+
+        self.assertEqual(self.files('--changed-since', 'HEAD'),
+                         ['b.py', os.path.join('pkg', 'new.py')])
+
+        r = self.runner.invoke(main, ['--changed-since', 'nope', 'def'])
+        self.assertNotEqual(r.exit_code, 0)
+
+    def test_read_git_index(self):
+        self.write('pkg/sub/f.py')
+        git('add', '-N', 'pkg/sub/f.py')
+
+        expected = sorted(['.hidden/e.py', 'a.py', 'b.py', 'pkg/c.py',
+                           'pkg/d.txt', 'pkg/sub/f.py'])
+        for version in ('2', '3', '4'):
+            git('update-index', '--index-version', version)
+            self.assertEqual(
+                read_git_index(os.path.join(find_git_dir('pkg'), 'index')),
+                expected, version)
+
+
+class TestIgnoreFile(unittest.TestCase):
+    def match(self, pattern, path, is_dir=False):
+        return IgnoreFile('root', [pattern]).match(
+            os.path.join('root', *path.split('/')), is_dir)
+
+    def test_patterns(self):
+        self.assertTrue(self.match('foo.py', 'foo.py'))
+        self.assertTrue(self.match('foo.py', 'a/b/foo.py'))
+        self.assertIsNone(self.match('foo.py', 'foo.pyc'))
+        self.assertTrue(self.match('*.py', 'a/foo.py'))
+        self.assertTrue(self.match('/foo', 'foo', True))
+        self.assertIsNone(self.match('/foo', 'a/foo', True))
+        self.assertTrue(self.match('a/*.py', 'a/foo.py'))
+        self.assertIsNone(self.match('a/*.py', 'a/b/foo.py'))
+        self.assertTrue(self.match('a/**/foo.py', 'a/b/c/foo.py'))
+        self.assertTrue(self.match('a/**/foo.py', 'a/foo.py'))
+        self.assertTrue(self.match('**/build', 'x/build', True))
+        self.assertTrue(self.match('a/**', 'a/b/c.py'))
+        self.assertTrue(self.match('fo[a-z].py', 'foo.py'))
+        self.assertIsNone(self.match('fo[!a-z].py', 'foo.py'))
+        self.assertTrue(self.match('f?o.py', 'foo.py'))
+        self.assertIsNone(self.match('build/', 'build'))
+        self.assertTrue(self.match('build/', 'build', True))
+
+    def test_negation(self):
+        ignore = IgnoreFile('root', ['*.py', '!foo.py', 'x/'])
+        path = os.path.join('root', 'foo.py')
+
+        self.assertFalse(ignore.match(path, False))
+        self.assertTrue(ignore.match(os.path.join('root', 'bar.py'), False))
+        self.assertTrue(ignore.match(os.path.join('root', 'x'), True))
+        self.assertIsNone(ignore.match(os.path.join('root', 'x'), False))
+        self.assertIsNone(ignore.match(os.path.join('other', 'bar.py'),
+                                       False))
+
+
+class TestSourceLines(unittest.TestCase):
+    def test_get(self):
+        lines = SourceLines(b'foo()\r\nbar()\n\nbaz()')
+
+        self.assertEqual(lines.get(1), 'foo()\r\n')
+        self.assertEqual(lines.get(2), 'bar()\n')
+        self.assertEqual(lines.get(3), '\n')
+        self.assertEqual(lines.get(4), 'baz()')
+        self.assertIsNone(lines.get(0))
+        self.assertIsNone(lines.get(5))
+
+    def test_trailing_newline(self):
+        lines = SourceLines(b'foo()\n')
+
+        self.assertEqual(lines.get(1), 'foo()\n')
+        self.assertIsNone(lines.get(2))
+
 
 if __name__ == '__main__':
     unittest.main()
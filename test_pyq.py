@@ -1,7 +1,20 @@
-from pyq.astmatch import ASTMatchEngine
+from pyq.astmatch import ASTMatchEngine, ASTParser
+from pyq.cache import ParseCache
+from pyq.index import SymbolIndex
+from pyq.output import match_records
+from pyq.server import Server, Workspace
 
 import unittest
+import io
+import json
 import os.path
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 import ast
 
 
@@ -271,5 +284,452 @@ class TestASTMatchEngine(unittest.TestCase):
         self.assertEqual(len(matches7), 1)
         self.assertEqual(len(matches8), 1)
 
+    def test_dispatch(self):
+        module = ast.parse('class Foo(Bar): pass\nfoo(x, y=1)')
+        cls, call = module.body[0], module.body[1].value
+
+        self.assertTrue(self.m.match_type('class', cls))
+        self.assertFalse(self.m.match_type('class', call))
+        self.assertFalse(self.m.match_type('unknown', cls))
+
+        self.assertTrue(self.m.match_id('Foo', cls))
+        self.assertTrue(self.m.match_id('foo', call))
+        self.assertFalse(self.m.match_id('Foo', module.body[1]))
+
+        self.assertTrue(self.m.match_attr('name', '=', 'Foo', cls))
+        self.assertTrue(self.m.match_attr('name', '^=', 'fo', call))
+        self.assertTrue(self.m.match_attr('kwarg', '=', 'y', call))
+        self.assertTrue(self.m.match_attr('arg', '$=', 'x', call))
+        self.assertFalse(self.m.match_attr('arg', '=', 'x', cls))
+        self.assertFalse(self.m.match_attr('unknown', '=', 'x', cls))
+
+        with self.assertRaises(Exception):
+            self.m.compile_attr('name', '~=', 'x')
+
+    def test_iter_data_order(self):
+        module = ast.parse('x = foo.bar(y)[0] + baz\nlambda: foo')
+        nodes = [n for n, body in self.m.iter_data(module.body)]
+
+        self.assertEqual(
+            [type(n).__name__ for n in nodes],
+            ['Assign', 'Subscript', 'Attribute', 'Name', 'Call', 'Name',
+             'BinOp', 'Lambda'])
+
+    def test_iter_data_deep(self):
+        module = ast.parse('x = a' + '.b' * 2000)
+        nodes = list(self.m.iter_data(module.body))
+
+        self.assertEqual(len(nodes), 2002)
+        self.assertEqual(
+            sum(1 for n, body in nodes if isinstance(n, ast.Attribute)), 2000)
+
+    def test_required_tokens(self):
+        tokens = self.m.required_tokens(
+            self.m.compile('class:extends(#A):has(call[kwarg=x]) > def'))
+        self.assertEqual(tokens, [frozenset((b'class', b'A', b'x', b'def'))])
+
+        tokens = self.m.required_tokens(
+            self.m.compile('import[from=foo.bar], call#baz'))
+        self.assertEqual(tokens, [frozenset((b'import', b'foo', b'bar')),
+                                  frozenset((b'baz',))])
+
+        self.assertIsNone(self.m.required_tokens(self.m.compile('call')))
+        self.assertIsNone(
+            self.m.required_tokens(self.m.compile('class, call')))
+        self.assertEqual(
+            self.m.required_tokens(self.m.compile('call:not(#foo)')), None)
+        self.assertEqual(
+            self.m.required_tokens(self.m.compile('[name!=foo]')), None)
+
+    def test_has_tokens(self):
+        alternatives = [frozenset((b'class', b'Foo'))]
+
+        self.assertTrue(self.m.has_tokens(b'class Foo: pass', alternatives))
+        self.assertFalse(self.m.has_tokens(b'class Bar: pass', alternatives))
+
+        # non-ASCII identifiers are normalized by the parser
+        source = u'class \uff26oo: pass'.encode('utf-8')
+        if sys.version_info[0] >= 3:
+            self.assertTrue(self.m.has_tokens(source, alternatives))
+
+    def test_prefilter(self):
+        self.assertEqual(
+            len(list(self.m.match('class#Unknown',
+                                  self.filepath('classes.py')))), 0)
+        self.assertEqual(
+            len(list(self.m.match('class:extends(attr#B)',
+                                  self.filepath('classes.py')))), 1)
+
+    def test_match_source(self):
+        # the given source is used instead of reading the file
+        source = b'class Unknown(object):\n    pass\n'
+        matches = list(self.m.match('class#Unknown',
+                                    self.filepath('classes.py'), source))
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(matches[0][1], 1)
+
+    def test_match_many(self):
+        rules = self.m.compile_rules([
+            ('classes', 'class'),
+            ('methods', 'class > def'),
+            ('unknown', 'class#Unknown'),
+            ('bases', 'class:extends(attr#B)'),
+        ])
+        filename = self.filepath('classes.py')
+        matches = list(self.m.match_many(rules, filename))
+        self.assertEqual(len(matches), 8)
+
+        # the same matches as one search per rule, in the order of the file
+        for rule_id, selector in rules:
+            self.assertEqual(
+                set((lineno, node.col_offset) for rule, node, lineno
+                    in matches if rule == rule_id),
+                set((lineno, node.col_offset)
+                    for node, lineno in self.m.match(selector, filename)))
+        self.assertEqual(matches[0][0], 'classes')
+
+        # files are not parsed when no rule can match
+        self.assertEqual(list(self.m.match_many(
+            [('unknown', 'class#Unknown')], filename, b'class Foo: pass\n')),
+            [])
+        with self.assertRaises(SyntaxError):
+            list(self.m.match_many([('unknown', 'class#Unknown')], filename,
+                                   b'class Unknown: (\n'))
+
+    def test_parser(self):
+        parser = ASTParser()
+
+        module = parser.parse(b'# -*- coding: latin-1 -*-\nx = "\xe9"\n')
+        self.assertEqual(ast.literal_eval(module.body[0].value), u'\xe9')
+
+        # bytes that do not match the declared encoding are replaced
+        for source in (b'x = "\xe9"\ny = 1\n',
+                       b'# coding: unknown\nx = "\xe9"\ny = 1\n'):
+            module = parser.parse(source)
+            self.assertEqual(len(module.body), 2)
+            self.assertEqual(ast.literal_eval(module.body[0].value),
+                             u'\ufffd')
+
+        with self.assertRaises(SyntaxError):
+            parser.parse(b'x = (\n')
+
+    def test_parse_errors(self):
+        errors = []
+        m = ASTMatchEngine(on_error=lambda fn, e: errors.append(fn))
+
+        self.assertEqual(list(m.match('class', 'bad.py', b'class (\n')), [])
+        self.assertEqual(list(m.match_many([('classes', 'class')], 'bad.py',
+                                           b'class Foo:\n\0')), [])
+        self.assertEqual(errors, ['bad.py', 'bad.py'])
+
+        with self.assertRaises(SyntaxError):
+            list(self.m.match('class', 'bad.py', b'class (\n'))
+
+    def test_bottom_up(self):
+        source = (b'class A(b.B):\n'
+                  b'    def __init__(self):\n'
+                  b'        f(g(x.y))\n'
+                  b'        class C:\n'
+                  b'            def m(self):\n'
+                  b'                return h(x)\n'
+                  b'        f(1)\n'
+                  b'def g():\n'
+                  b'    def f():\n'
+                  b'        x.y.z = f(2)\n'
+                  b'    return f()\n')
+
+        def match(selector):
+            return [(lineno, node.col_offset) for node, lineno in
+                    self.m.match(selector, 'nested.py', source)]
+
+        self.assertEqual(len(match('def call')), 5)
+        for selector in ('class > def', 'class def', 'def call', '> class',
+                         'def def', 'class def > call', 'def > call',
+                         'class:extends(attr) > def#__init__ > call',
+                         'class > def > call, def attr'):
+            self.m.evaluation = self.m.TOP_DOWN
+            expected = match(selector)
+            self.m.evaluation = self.m.BOTTOM_UP
+            self.assertEqual(match(selector), expected, selector)
+
+    def test_strategy(self):
+        def strategy(selector):
+            return self.m.strategy(self.m.compile(selector)[0])
+
+        self.assertEqual(strategy('def'), self.m.TOP_DOWN)
+        self.assertEqual(strategy('def call#eval'), self.m.BOTTOM_UP)
+        self.assertEqual(strategy('class def attr#path'), self.m.BOTTOM_UP)
+        self.assertEqual(strategy('> class > def'), self.m.TOP_DOWN)
+        self.assertEqual(strategy('assign call'), self.m.TOP_DOWN)
+
+
+class TestParseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = ParseCache(os.path.join(self.tmpdir, 'cache'))
+        self.m = ASTMatchEngine(cache=self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def filepath(self, filename):
+        return os.path.join(os.path.dirname(__file__), 'testfiles', filename)
+
+    def lines(self, selector, filename):
+        return [(type(node), lineno, node.col_offset)
+                for node, lineno in self.m.match(selector, filename)]
+
+    def test_cached_matches(self):
+        selectors = ('class', 'class > def', 'class:extends(attr#B)',
+                     'class:not(:has(def))', 'call[kwarg=x]', 'assign#b',
+                     'import[full=foo.bar2]', 'attr')
+
+        for fn in ('classes.py', 'calls.py', 'assign.py', 'imports.py',
+                   'attrs.py'):
+            uncached = [self.lines(selector, self.filepath(fn))
+                        for selector in selectors]
+            self.assertIsNotNone(self.cache.get(self.filepath(fn)))
+            cached = [self.lines(selector, self.filepath(fn))
+                      for selector in selectors]
+            self.assertEqual(cached, uncached)
+
+    def test_invalidation(self):
+        filename = os.path.join(self.tmpdir, 'foo.py')
+        with open(filename, 'w') as fp:
+            fp.write('def foo():\n    pass\n')
+
+        self.assertEqual(len(self.lines('def', filename)), 1)
+
+        with open(filename, 'w') as fp:
+            fp.write('def foo():\n    pass\n\n\ndef bar():\n    pass\n')
+
+        self.assertIsNone(self.cache.get(filename))
+        self.assertEqual(len(self.lines('def', filename)), 2)
+
+    def test_prune(self):
+        self.cache.max_size = 0
+        self.lines('class', self.filepath('classes.py'))
+        self.assertTrue(os.listdir(self.cache.directory))
+
+        self.cache.prune()
+        self.assertFalse(os.listdir(self.cache.directory))
+
+
+class TestSymbolIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.m = ASTMatchEngine()
+        self.index = SymbolIndex(os.path.join(self.tmpdir, 'index'), self.m)
+        self.files = [self.filepath(fn) for fn in (
+            'assign.py', 'attrs.py', 'calls.py', 'classes.py', 'ids.py',
+            'imports.py')]
+        self.index.update(self.files)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def filepath(self, filename):
+        return os.path.join(os.path.dirname(__file__), 'testfiles', filename)
+
+    def test_answerable(self):
+        for selector in ('class', 'call#foo', 'import[from=foo][name=bar]',
+                         'class:extends(#object, #X)', 'class:extends()',
+                         'def, assign#foo'):
+            self.assertTrue(self.index.answerable(selector), selector)
+
+        for selector in ('#foo', 'class > def', '> class', 'def:has(call)',
+                         'class:extends(attr#B)', 'call[foo=bar]',
+                         'class, #foo'):
+            self.assertFalse(self.index.answerable(selector), selector)
+
+    def test_matches(self):
+        for selector in ('class', 'def', 'import', 'assign', 'call', 'attr',
+                         'call#foo', 'assign#b', 'attr#z', 'import[from=foo]',
+                         'import[name^=foo]', 'import[full=foo.bar2]',
+                         'call[kwarg=x]', 'call[arg=bang]', 'def[name!=baz]',
+                         'class:extends(#object)', 'class:extends()',
+                         'class:extends(#X):extends(#Y)', 'def, class#foo'):
+            for fn in self.files:
+                expected = [(lineno, node.col_offset)
+                            for node, lineno in self.m.match(selector, fn)]
+                indexed = [(lineno, node.col_offset)
+                           for node, lineno in self.index.match(selector, fn)]
+                self.assertEqual(indexed, expected, (selector, fn))
+
+    def test_update(self):
+        filename = os.path.join(self.tmpdir, 'foo.py')
+        with open(filename, 'w') as fp:
+            fp.write('def foo():\n    pass\n')
+
+        self.assertEqual(self.index.update([filename] + self.files), 1)
+        self.assertEqual(len(self.index.match('def', filename)), 1)
+
+        with open(filename, 'w') as fp:
+            fp.write('def foo():\n    pass\n\n\ndef bar():\n    pass\n')
+
+        self.assertIsNone(self.index.match('def', filename))
+        self.assertEqual(self.index.update([filename] + self.files), 1)
+        self.assertEqual(len(self.index.match('def', filename)), 2)
+
+        os.remove(filename)
+        self.assertEqual(self.index.prune(), 1)
+
+    def test_schema_version(self):
+        path = os.path.join(self.tmpdir, 'old')
+        db = sqlite3.connect(path)
+        db.execute('CREATE TABLE nodes (id INTEGER PRIMARY KEY)')
+        db.close()
+
+        # index files of older versions are emptied
+        index = SymbolIndex(path, self.m)
+        self.assertEqual(index.update(self.files), len(self.files))
+        self.assertIsNotNone(index.match('def', self.files[0]))
+        index.close()
+
+    def test_records(self):
+        for fn in self.files:
+            expected = list(match_records(self.m, fn, self.m.match(
+                'class, def, call, import', fn)))
+            indexed = list(match_records(self.m, fn, self.index.match(
+                'class, def, call, import', fn)))
+            self.assertEqual(indexed, expected, fn)
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.currentdir = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+        self.write('foo.py', 'def foo():\n    pass\n')
+        self.write('bar.py', 'class Bar(object):\n    def foo(self):\n'
+                             '        pass\n')
+        self.write('broken.py', 'def (:\n')
+
+        self.workspace = Workspace(['.'])
+        self.workspace.refresh()
+        self.server = Server(self.workspace)
+
+    def tearDown(self):
+        os.chdir(self.currentdir)
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, filename, source):
+        with open(filename, 'w') as fp:
+            fp.write(source)
+
+    def request(self, method, params=None, request_id=1):
+        request = {'jsonrpc': '2.0', 'method': method, 'id': request_id}
+        if params is not None:
+            request['params'] = params
+        return self.server.handle(json.dumps(request))
+
+    def test_search(self):
+        results = self.workspace.search('def#foo')
+        self.assertEqual([(r['path'], r['line'], r['text']) for r in results],
+                         [('bar.py', 2, 'def foo(self):'),
+                          ('foo.py', 1, 'def foo():')])
+        self.assertEqual(len(self.workspace.search('def', limit=1)), 1)
+
+    def test_refresh(self):
+        self.write('foo.py', 'def foo():\n    pass\n\n\ndef baz():\n'
+                             '    pass\n')
+        # mtime may not have changed, the size did
+        os.remove('bar.py')
+
+        self.assertEqual(self.workspace.refresh(),
+                         {'files': 2, 'parsed': 1, 'removed': 1})
+        self.assertEqual([r['name'] for r in self.workspace.search('def')],
+                         ['foo', 'baz'])
+        self.assertEqual(self.workspace.refresh()['parsed'], 0)
+
+    def test_rpc(self):
+        response = self.request('search', {'selector': 'class'})
+        self.assertEqual(response['id'], 1)
+        self.assertEqual(response['result'][0]['name'], 'Bar')
+
+        response = self.request('search', ['def', 1], request_id='x')
+        self.assertEqual(response['id'], 'x')
+        self.assertEqual(len(response['result']), 1)
+
+        self.assertEqual(self.request('refresh')['result']['parsed'], 0)
+
+        self.assertEqual(self.request('nope')['error']['code'], -32601)
+        self.assertEqual(self.request('search', {'x': 1})['error']['code'],
+                         -32602)
+        self.assertEqual(self.request('search', {'selector': ':x()'})[
+            'error']['code'], -32000)
+        error = self.request('search', {'selector': 'def:has()'})['error']
+        self.assertEqual(error['code'], -32000)
+        self.assertIn("Expected selector in ':has()'", error['message'])
+        self.assertEqual(self.server.handle('{')['error']['code'], -32700)
+        self.assertEqual(self.server.handle('[]'), {
+            'jsonrpc': '2.0', 'id': None,
+            'error': {'code': -32600, 'message': 'Invalid request'}})
+        # a batch of notifications has no response
+        self.assertIsNone(self.server.handle(json.dumps(
+            [{'jsonrpc': '2.0', 'method': 'refresh'}])))
+        self.assertEqual(self.server.handle('1')['error']['code'], -32600)
+
+        # notifications have no response, even when they fail
+        for request in ({'method': 'refresh'}, {'method': 'nope'},
+                        {'method': 'search', 'params': {'x': 1}}):
+            request['jsonrpc'] = '2.0'
+            self.assertIsNone(self.server.handle(json.dumps(request)))
+
+        # only arguments that do not match are invalid params
+        def fail(selector):
+            raise TypeError('failed')
+        self.server.methods['fail'] = fail
+        error = self.request('fail', ['def'])['error']
+        self.assertEqual(error['code'], -32000)
+        self.assertEqual(error['message'], 'failed')
+        self.assertEqual(self.request('fail', [])['error']['code'], -32602)
+        self.assertEqual(self.request('search', 'def')['error']['code'],
+                         -32602)
+
+    def test_stdio(self):
+        stdin = io.StringIO(
+            u'{"jsonrpc": "2.0", "id": 1, "method": "search", '
+            u'"params": {"selector": "def#foo"}}\n\n'
+            u'{"jsonrpc": "2.0", "id": 2, "method": "shutdown"}\n'
+            u'{"jsonrpc": "2.0", "id": 3, "method": "refresh"}\n')
+        stdout = io.StringIO()
+        self.server.serve_stdio(stdin, stdout)
+
+        responses = [json.loads(line) for line in
+                     stdout.getvalue().splitlines()]
+        self.assertEqual([r['id'] for r in responses], [1, 2])
+        self.assertEqual(len(responses[0]['result']), 2)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'no Unix sockets')
+    def test_unix_socket(self):
+        path = os.path.join(self.tmpdir, 'socket')
+        thread = threading.Thread(target=self.server.serve_unix, args=(path,))
+        thread.start()
+        try:
+            for i in range(100):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.01)
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            fp = client.makefile('rwb')
+            fp.write(b'{"jsonrpc": "2.0", "id": 1, "method": "search", '
+                     b'"params": {"selector": "class"}}\n')
+            fp.flush()
+            response = json.loads(fp.readline().decode('utf-8'))
+            fp.close()
+            client.close()
+
+            self.assertEqual(response['result'][0]['name'], 'Bar')
+        finally:
+            self.server.shutdown()
+            thread.join()
+
+        self.assertFalse(os.path.exists(path))
+
 
 unittest.main(failfast=True)
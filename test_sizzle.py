@@ -1,4 +1,4 @@
-from sizzle.selector import Selector
+from sizzle.selector import Selector, SelectorGroup, SelectorSyntaxError
 from sizzle.match import MatchEngine
 
 import unittest
@@ -158,6 +158,95 @@ class TestSObjs(unittest.TestCase):
         self.assertEqual(sobjs[0].pseudos[0].name, 'not')
         self.assertEqual(sobjs[0].pseudos[0].value, '[name=1]')
 
+    def test_pseudo_parentheses(self):
+        sobjs = Selector.parse('def:has(call:not([id=f(])) > call')
+
+        self.assertEqual(len(sobjs), 1)
+        self.assertEqual(sobjs[0].pseudos[0].value, 'call:not([id=f(])')
+        self.assertEqual(sobjs[0].next_selector.name, 'call')
+
+    def test_combinators(self):
+        sobjs = Selector.parse('> class def ~ def,+ call')
+
+        self.assertEqual(len(sobjs), 2)
+        self.assertEqual(sobjs[0].combinator, Selector.CHILD)
+        self.assertEqual(sobjs[0].next_selector.combinator,
+                         Selector.DESCENDANT)
+        self.assertEqual(sobjs[0].next_selector.next_selector.combinator,
+                         Selector.SIBLING)
+        self.assertEqual(sobjs[1].name, 'call')
+        self.assertEqual(sobjs[1].combinator, Selector.ADJACENT)
+
+    def test_empty(self):
+        self.assertEqual(Selector.parse(''), [])
+        self.assertEqual(Selector.parse('  '), [])
+
+    def test_syntax_errors(self):
+        for selector, position in (
+                ('def!', 3),
+                ('class,', 6),
+                ('class, ,def', 7),
+                ('class >', 7),
+                ('def#', 4),
+                ('def:has', 7),
+                ('def:has(call', 7),
+                ('[name]', 5),
+                ('[=1]', 1),
+                ('[name=1', 0),
+                (':not([name=1)', 5),
+                ('class def)', 9)):
+            with self.assertRaises(SelectorSyntaxError) as cm:
+                Selector.parse(selector)
+            self.assertEqual(cm.exception.selector, selector)
+            self.assertEqual(cm.exception.position, position, selector)
+
+    def test_syntax_error_in_pseudo(self):
+        # only raised when the argument is parsed as a selector
+        group = Selector.compile(':lang(en-US)')
+
+        self.assertEqual(group[0].pseudos[0].value, 'en-US')
+        with self.assertRaises(SelectorSyntaxError):
+            Selector.compile('en-US')
+
+    def test_pseudo_arguments(self):
+        # arguments of :not and :has are compiled with the selector, errors
+        # are positioned in the whole string
+        for selector, position in (
+                ('def:not(!)', 8),
+                ('def:has(!)', 8),
+                ('def:has(call:not(>))', 18),
+                ('def:not(:has(def#))', 17),
+                ('def:has()', 8),
+                ('def:not( )', 8),
+                ('def:has(:not())', 13)):
+            with self.assertRaises(SelectorSyntaxError) as cm:
+                Selector.compile(selector)
+            self.assertEqual(cm.exception.selector, selector)
+            self.assertEqual(cm.exception.position, position, selector)
+
+        with self.assertRaises(SelectorSyntaxError) as cm:
+            Selector.compile('def:has()')
+        self.assertIn("Expected selector in ':has()'", str(cm.exception))
+
+        # parsing alone keeps the arguments as written
+        self.assertEqual(Selector.parse('def:has()')[0].pseudos[0].value, '')
+
+    def test_compile(self):
+        group = Selector.compile('class > def, :not(:has(def))')
+
+        self.assertIsInstance(group, SelectorGroup)
+        self.assertEqual(len(group), 2)
+        self.assertEqual(group.source, 'class > def, :not(:has(def))')
+        self.assertEqual(group[0].next_selector.name, 'def')
+
+        # compiled groups and pseudo arguments are memoized
+        self.assertIs(Selector.compile('class > def, :not(:has(def))'),
+                      group)
+        self.assertIs(Selector.compile(':has(def)'),
+                      Selector.compile(':has(def)'))
+        self.assertEqual(Selector.compile(':has(def)')[0].pseudos[0].value,
+                         'def')
+
 
 class CustomMatchEngine(MatchEngine):
     def __init__(self):
@@ -245,5 +334,104 @@ class TestCustomMatcher(unittest.TestCase):
         self.assertEqual(len(self.match(':has(def)')), 4)
         self.assertEqual(len(self.match(':has(> def)')), 3)
 
+    def test_pseudo_has_nested(self):
+        def names(selector):
+            return [node.name for node in self.match(selector)]
+
+        # nested classes are checked after their ancestors walked them
+        self.assertEqual(names('class:has(def#bang)'),
+                         ['Test', 'Test3', 'Test5'])
+        self.assertEqual(names('class:has(> def#bang)'), ['Test5'])
+        self.assertEqual(names('class:has(class > def)'), ['Test', 'Test3'])
+        self.assertEqual(names('class:not(:has(class))'),
+                         ['Test2', 'Test5', 'Test4'])
+
+    def test_bottom_up(self):
+        # the same nodes in the same order whatever the evaluation
+        for selector in ('class > def', 'class def', 'class class def',
+                         '> class > class', 'class > class def#bang',
+                         'class:extends() > def', ':not(def) class'):
+            self.matcher.evaluation = MatchEngine.TOP_DOWN
+            expected = self.match(selector)
+            self.matcher.evaluation = MatchEngine.BOTTOM_UP
+            self.assertEqual(self.match(selector), expected, selector)
+
+        self.assertEqual([node.name for node in self.match('class class def')],
+                         ['baz', 'bang'])
+
+    def test_duplicates(self):
+        # nodes found through several ancestors or selectors come once, in
+        # the order they are first found
+        for evaluation in (MatchEngine.TOP_DOWN, MatchEngine.BOTTOM_UP):
+            self.matcher.evaluation = evaluation
+            for selector in ('class def', 'class class def', 'def, class',
+                             'class, class > def, def', 'class def, def'):
+                nodes = self.match(selector)
+                self.assertEqual(len(set(map(id, nodes))), len(nodes),
+                                 selector)
+
+            self.assertEqual(self.match('class, def'),
+                             self.match('class') + self.match('def'))
+            nested = self.match('class def')
+            self.assertEqual(
+                list(map(id, self.match('class def, def'))),
+                list(map(id, nested)) + [
+                    id(node) for node in self.match('def')
+                    if not any(node is other for other in nested)])
+
+    def test_repeats(self):
+        compile = self.matcher.compile
+        self.assertFalse(self.matcher.repeats(compile('def')[0]))
+        self.assertFalse(self.matcher.repeats(compile('> class > def')[0]))
+        self.assertTrue(self.matcher.repeats(compile('class def')[0]))
+        self.assertTrue(self.matcher.repeats(compile('> class def')[0]))
+
+    def test_compiled(self):
+        selector = self.matcher.compile('class > def, :has(def)')
+
+        self.assertIs(self.matcher.compile(selector), selector)
+        self.assertEqual(list(self.matcher.match(selector, self.data)),
+                         self.match('class > def, :has(def)'))
+
+    def test_predicate(self):
+        selector = self.matcher.compile('class#Test2:has(def):extends()')[0]
+        predicate = self.matcher.predicate(selector)
+
+        self.assertIs(self.matcher.predicate(selector), predicate)
+        self.assertTrue(predicate(self.data[0].body[2]))
+        self.assertFalse(predicate(self.data[0]))
+        self.assertFalse(predicate(self.data[2]))
+
+    def test_match_many(self):
+        rules = [('classes', 'class'), ('methods', 'class > def'),
+                 ('foo', 'def#foo, class:extends(object)')]
+        matches = [(rule, node.name) for rule, node in
+                   self.matcher.match_many(rules, self.data)]
+
+        # in the order nodes are found, then in the order of the rules
+        self.assertEqual(matches[:4], [('classes', 'Test'), ('foo', 'Test'),
+                                       ('methods', 'foo'), ('foo', 'foo')])
+        for rule_id, selector in rules:
+            self.assertEqual(
+                sorted(name for rule, name in matches if rule == rule_id),
+                sorted(node.name for node in self.match(selector)))
+
+        self.assertEqual(list(self.matcher.match_many({}, self.data)), [])
+
+    def test_unknown_pseudo(self):
+        # raised when compiling, even if no node would reach the pseudo
+        with self.assertRaises(SelectorSyntaxError) as cm:
+            self.match('def#nothing:unknown()')
+        self.assertEqual(cm.exception.position, 12)
+        self.assertIn("Unknown pseudo ':unknown()'", str(cm.exception))
+
+        with self.assertRaises(SelectorSyntaxError) as cm:
+            self.match('def:has(call:unknown())')
+        self.assertEqual(cm.exception.position, 13)
+
+        # any pseudo is accepted by the selector alone
+        self.assertEqual(Selector.compile('def:unknown()')[0].pseudos[0].name,
+                         'unknown')
+
 
 unittest.main(failfast=True)